@@ -1,20 +1,854 @@
+import os
 import re
+import json
+import hashlib
+import tempfile
 import unicodedata
+from bisect import bisect
+import heapq
+from itertools import chain
+from collections import Counter
+from contextlib import ExitStack
+from functools import lru_cache
 import joblib
-from rapidfuzz.process import cdist
-from rapidfuzz.distance.Levenshtein import normalized_similarity
+from rapidfuzz.process import cdist, cpdist
+from rapidfuzz.distance.Levenshtein import normalized_similarity, opcodes
 from rapidfuzz.fuzz import partial_ratio, partial_ratio_alignment
 import numpy as np
-from scipy.sparse import csr_matrix
-from scipy.sparse.csgraph import shortest_path
+from scipy.sparse import csr_matrix, issparse, save_npz, load_npz
+from scipy.sparse.csgraph import min_weight_full_bipartite_matching
+from scipy.optimize import linear_sum_assignment
 import click
 
 SUBSEG_LEN_MIN = 20 # string length above which subsegmentation is attempted
 SUBSEG_ACC_MAX = 0.9 # alignment accuracy below which subsegmentation is attempted
 SUBSEG_ACC_MIN = 0.0 # alignment accuracy above which subsegmentation is attempted
 PARTIAL_ACC_MIN = 50 # minimum subalignment score during subsegmentation
+BLOCKING_NGRAM = 3 # character n-gram length for candidate blocking
+BLOCKING_DF_MAX = 0.05 # fraction of l2 strings above which n-grams are too common for blocking
+PREFILTER_TOPK_FACTOR = 4 # candidates to keep per topk pair when prefiltering without cutoff
+BAND_ACC_MIN = 0.5 # alignment accuracy below which the band gets widened
+NORMALIZATION_CACHE = 2 ** 16 # number of normalized strings to memoize
+SIMILARITY_CACHE_SIZE = 2 ** 30 # bytes of similarity matrices to keep on disk
+DIAGONAL_BONUS = 1e-3 # relative gain of pairs on the diagonal in optimal assignment
+BLOCK_ACC_MIN = 0.3 # alignment accuracy of blocks below which their strings are aligned globally
+ANCHOR_LEN_MIN = 10 # string length above which unique matches can become anchors
+SPLIT_SIZE_MAX = 3 # maximum number of consecutive l1 strings to pair with one l2 string in monotone alignment
+WINDOW_ACC_MIN = 0.7 # alignment accuracy above which a string can locate the window in window search
+WINDOW_MARGIN = 5 # number of strings to extend a window by on either side in window search
 
-def match(l1, l2, workers=1, normalization=None, cutoff=None, try_subseg=False, interactive=False):
+class Normalizer:
+    """Compiled string normalization.
+
+    Applies the regex replacement pairs of ``normalization`` in order, followed
+    by Unicode NFKC composition. Patterns are compiled only once; consecutive
+    single-character literal replacements are combined into a translation
+    table (as long as they do not feed into each other). Results are memoized
+    per string.
+
+    Instances are shared among all calls with the same ``normalization``
+    (see :py:func:`get_normalizer`).
+    """
+    def __init__(self, normalization=None):
+        self.rules = []
+        for pattern, replacement in (normalization or {}).items():
+            if (len(pattern) == 1 and pattern not in '.^$*+?{}[]\\|()' and
+                '\\' not in replacement):
+                if (self.rules and isinstance(self.rules[-1], dict) and
+                    not any(pattern in value for value in self.rules[-1].values())):
+                    self.rules[-1][ord(pattern)] = replacement
+                else:
+                    self.rules.append({ord(pattern): replacement})
+            else:
+                self.rules.append((re.compile(pattern), replacement))
+        self.normalize = lru_cache(maxsize=NORMALIZATION_CACHE)(self._normalize)
+
+    def _normalize(self, s):
+        for rule in self.rules:
+            if isinstance(rule, dict):
+                s = s.translate(rule)
+            else:
+                pattern, replacement = rule
+                s = pattern.sub(replacement, s)
+        return unicodedata.normalize('NFKC', s)
+
+    def __call__(self, s):
+        return self.normalize(s)
+
+@lru_cache(maxsize=16)
+def _get_normalizer(normalization):
+    return Normalizer(dict(normalization))
+
+def get_normalizer(normalization=None):
+    """Get the (shared) :py:class:`Normalizer` for ``normalization`` rules."""
+    return _get_normalizer(tuple((normalization or {}).items()))
+
+class SimilarityCache:
+    """On-disk cache of similarity matrices.
+
+    Stores each matrix under a content hash of the (normalized) strings
+    and the scoring setup: dense matrices as ``.npy`` files (loaded as
+    copy-on-write memory maps), sparse matrices as ``.npz`` files.
+    Whenever the total size exceeds ``max_size`` bytes, removes the
+    least recently used entries.
+    """
+    def __init__(self, directory, max_size=SIMILARITY_CACHE_SIZE):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_size = max_size
+
+    @staticmethod
+    def key(l1, l2, **params):
+        """Get content hash of string lists and scoring parameters."""
+        digest = hashlib.sha256(json.dumps(params, sort_keys=True).encode('utf-8'))
+        for strings in [l1, l2]:
+            digest.update(b'%d\0' % len(strings))
+            for string in strings:
+                string = string.encode('utf-8')
+                digest.update(b'%d\0' % len(string))
+                digest.update(string)
+        return digest.hexdigest()
+
+    def load(self, key):
+        """Get matrix stored under key, or None if not cached."""
+        for suffix, loader in [('.npy', lambda path: np.load(path, mmap_mode='c')),
+                               ('.npz', load_npz)]:
+            path = os.path.join(self.directory, key + suffix)
+            try:
+                matrix = loader(path)
+            except FileNotFoundError:
+                continue
+            os.utime(path) # mark as recently used
+            return matrix
+        return None
+
+    def store(self, key, matrix):
+        """Store matrix under key, then evict old entries if needed."""
+        with tempfile.NamedTemporaryFile(dir=self.directory, suffix='.tmp', delete=False) as output:
+            if issparse(matrix):
+                suffix = '.npz'
+                save_npz(output, matrix, compressed=False)
+            else:
+                suffix = '.npy'
+                np.save(output, matrix)
+        # atomic (for concurrent readers)
+        os.replace(output.name, os.path.join(self.directory, key + suffix))
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(('.npy', '.npz')):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass # concurrently removed
+            total -= size
+
+class MonotonicityIndex:
+    """Incremental index of assigned pairs for the monotonicity bonus in :py:func:`match`.
+
+    Keeps the pairs assigned so far sorted by their l1 index. Each pair of
+    successive pairs (with (0,0) and (L1,L2) as a priori edges) defines a block
+    of rows between them, which is compatible with the columns between them
+    if both are monotone, or with no column if they cross each other. A crossing
+    block also makes its columns incompatible for all rows above it.
+
+    Instead of a full boolean matrix, stores for each row the column interval
+    ``lo:hi`` of its block, and for each column the ``cross`` start row of the
+    lowest crossing block over it. Adding a pair only updates the two blocks
+    adjacent to it (after a binary search for its position).
+    """
+    def __init__(self, dim1, dim2):
+        self.dim1 = dim1
+        self.dim2 = dim2
+        self.anchors1 = []
+        self.anchors2 = []
+        self.lo = np.zeros(dim1, dtype=int)
+        self.hi = np.full(dim1, dim2, dtype=int)
+        self.cross = np.full(dim2, -1, dtype=int)
+
+    def add(self, ind1, ind2):
+        """Insert pair ``ind1,ind2`` and update the blocks before and after it.
+
+        Returns the row ranges (as start,end tuples) that may have become
+        compatible with more columns than before.
+        """
+        pos = bisect(self.anchors1, ind1)
+        if pos > 0:
+            prev_ind1, prev_ind2 = self.anchors1[pos - 1], self.anchors2[pos - 1]
+        else:
+            prev_ind1, prev_ind2 = 0, 0
+        if pos < len(self.anchors1):
+            next_ind1, next_ind2 = self.anchors1[pos], self.anchors2[pos]
+        else:
+            next_ind1, next_ind2 = self.dim1, self.dim2
+        self.anchors1.insert(pos, ind1)
+        self.anchors2.insert(pos, ind2)
+        # all rows between prev and next shared the same block so far
+        old_lo, old_hi = self.lo[ind1], self.hi[ind1]
+        widened = []
+        for beg1, beg2, end1, end2 in [(prev_ind1, prev_ind2, ind1, ind2),
+                                       (ind1, ind2, next_ind1, next_ind2)]:
+            self._set_block(beg1, beg2, end1, end2)
+            if beg2 < end2 and (beg2 < old_lo or end2 > old_hi):
+                widened.append((beg1, end1))
+        return widened
+
+    def _set_block(self, beg1, beg2, end1, end2):
+        if end2 >= beg2:
+            self.lo[beg1:end1] = beg2
+            self.hi[beg1:end1] = end2
+        else:
+            self.lo[beg1:end1] = 0
+            self.hi[beg1:end1] = 0
+            # (crossing blocks over these columns always start at some row
+            #  at least as large as the one they replace, so maximum suffices)
+            np.maximum(self.cross[end2:beg2], beg1, out=self.cross[end2:beg2])
+
+    def row(self, ind1, out=None):
+        """Get boolean vector of compatibility between row ``ind1`` and all columns."""
+        out = np.less_equal(self.cross, ind1, out=out)
+        out[:self.lo[ind1]] = False
+        out[self.hi[ind1]:] = False
+        return out
+
+    def mask(self, rows, cols):
+        """Get boolean matrix of compatibility between all ``rows`` and ``cols`` indexes."""
+        rows = rows[:, np.newaxis]
+        return ((cols >= self.lo[rows]) &
+                (cols < self.hi[rows]) &
+                (self.cross[cols] <= rows))
+
+class LazyGreedy:
+    """Lazy-greedy search for the next best pair in :py:func:`match`.
+
+    The priority of each pair is its ``dist`` similarity plus the current
+    ``coverage`` bonus if it is compatible with the ``mono`` index, multiplied
+    by its l2 ``length``. Instead of computing the argmax over all remaining
+    pairs for each assignment, keeps a heap of rows ordered by an upper bound
+    of their best priority: the exact value when last scored, plus the maximum
+    increase of the bonus since then. Only rows whose bound can still beat the
+    best exact priority found so far need to be re-scored. (Popped rows first
+    get their bound tightened by their own maximum length of compatible pairs.)
+
+    (Since assignments only ever remove rows and columns and shrink the
+     compatible blocks – except for the rows reported by the index when
+     adding a pair, which must be ``touch``ed –, the bounds stay valid, and
+     the result is identical to the argmax in row-major order.)
+
+    Rows are scored on preallocated buffers of ``dtype`` in full length,
+    masking assigned columns with ``-inf`` instead of copying the rest.
+    If ``dist`` is a sparse matrix, then only its stored entries are candidates
+    – unless ``implicit_zeros``, in which case all other pairs score 0 (with
+    rows filled into a dense buffer for scoring).
+    """
+    def __init__(self, dist, length, mono, keep1, keep2, dtype=np.float64, implicit_zeros=False):
+        self.dist = dist
+        self.implicit_zeros = implicit_zeros and issparse(dist)
+        self.dtype = np.dtype(dtype)
+        self.length = np.asarray(length, dtype=self.dtype)
+        self.mono = mono
+        self.keep1 = keep1
+        self.keep2 = keep2
+        # maximum bonus increase per unit of coverage
+        self.slope = float(self.length.max(initial=0))
+        self.tolerance = 16 * np.finfo(self.dtype).eps * (self.slope + 1)
+        self.version = np.zeros(len(keep1), dtype=int)
+        self.heap = []
+        # last exact priority, coverage and bonus slope of each row
+        self.exact = np.zeros(len(keep1))
+        self.coverage = np.zeros(len(keep1))
+        self.slopes = np.zeros(len(keep1))
+        self.fresh = np.zeros(len(keep1), dtype=bool)
+        # buffers
+        self.skip2 = np.empty(len(keep2), dtype=bool)
+        self.monotonicity = np.empty(len(keep2), dtype=bool)
+        self.priority = np.empty(len(keep2), dtype=self.dtype)
+        if self.implicit_zeros:
+            self.row = np.empty(len(keep2), dtype=dist.dtype)
+        self.touch(0, len(keep1))
+
+    def touch(self, beg1, end1):
+        """Force re-scoring of rows ``beg1:end1``."""
+        for ind1 in np.flatnonzero(self.keep1[beg1:end1]) + beg1:
+            self.version[ind1] += 1
+            self.fresh[ind1] = False
+            heapq.heappush(self.heap, (-np.inf, ind1, self.version[ind1]))
+
+    def score_row(self, ind1, coverage):
+        """Get the best priority, column and score for row ``ind1`` among the remaining columns.
+
+        Also returns the maximum length among compatible columns.
+        """
+        if self.implicit_zeros:
+            row = self.row
+            row.fill(0)
+            beg, end = self.dist.indptr[ind1], self.dist.indptr[ind1 + 1]
+            row[self.dist.indices[beg:end]] = self.dist.data[beg:end]
+        elif issparse(self.dist):
+            return self.score_row_sparse(ind1, coverage)
+        else:
+            row = self.dist[ind1]
+        monotonicity = self.mono.row(ind1, out=self.monotonicity)
+        slope = np.max(self.length, where=monotonicity, initial=0)
+        # score = (similarity [0.0-1.0] + monotonicity [0,] * coverage [0.0-0.5]) * length
+        priority = np.multiply(monotonicity, self.dtype.type(coverage), out=self.priority)
+        np.add(priority, row, out=priority)
+        np.multiply(priority, self.length, out=priority)
+        np.copyto(priority, -np.inf, where=self.skip2)
+        ind2 = np.argmax(priority)
+        return priority[ind2], ind2, row[ind2], slope
+
+    def score_row_sparse(self, ind1, coverage):
+        beg, end = self.dist.indptr[ind1], self.dist.indptr[ind1 + 1]
+        if beg == end:
+            return -np.inf, None, None, 0
+        cols = self.dist.indices[beg:end]
+        mono = self.mono
+        monotonicity = (cols >= mono.lo[ind1]) & (cols < mono.hi[ind1]) & (mono.cross[cols] <= ind1)
+        length = self.length[cols]
+        slope = np.max(length, where=monotonicity, initial=0)
+        priority = (self.dist.data[beg:end] + self.dtype.type(coverage) * monotonicity) * length
+        priority[self.skip2[cols]] = -np.inf
+        ind2 = np.argmax(priority)
+        return priority[ind2], cols[ind2], self.dist.data[beg + ind2], slope
+
+    def select(self, coverage):
+        """Find the pair with the highest priority among the remaining rows and columns.
+
+        Returns the row and column index and their score, or None if nothing remains.
+        """
+        np.logical_not(self.keep2, out=self.skip2)
+        if self.skip2.all():
+            return None
+        # bounds are stored relative to the coverage at scoring time
+        offset = coverage * self.slope
+        best = None
+        scored = []
+        while self.heap:
+            key, ind1, version = self.heap[0]
+            if not self.keep1[ind1] or version != self.version[ind1]:
+                heapq.heappop(self.heap) # stale
+                continue
+            if best is not None and offset - key + self.tolerance < best[0]:
+                break # no remaining row can beat it
+            heapq.heappop(self.heap)
+            if best is not None and self.fresh[ind1]:
+                bound = self.exact[ind1] + (coverage - self.coverage[ind1]) * self.slopes[ind1]
+                if bound + self.tolerance < best[0]:
+                    heapq.heappush(self.heap, (offset - bound, ind1, version))
+                    continue
+            priority, ind2, score, slope = self.score_row(ind1, coverage)
+            if priority == -np.inf:
+                continue # only rejected pairs left in this row
+            self.exact[ind1] = priority
+            self.coverage[ind1] = coverage
+            self.slopes[ind1] = slope
+            self.fresh[ind1] = True
+            scored.append(ind1)
+            # ties are resolved in row-major order like argmax
+            if best is None or priority > best[0] or (priority == best[0] and ind1 < best[1]):
+                best = priority, ind1, ind2, score
+        for ind1 in scored:
+            heapq.heappush(self.heap, (offset - self.exact[ind1], ind1, self.version[ind1]))
+        if best is None:
+            return None
+        return best[1:]
+
+def cdist_topk(queries, choices, topk, score_cutoff=None, max_memory=None, **kwargs):
+    """Compute a sparse similarity matrix like :py:func:`rapidfuzz.process.cdist`.
+
+    Calculates rows in chunks (using approximately up to ``max_memory``
+    bytes for each), keeping only the ``topk`` best scores of each row,
+    plus all scores at or above ``score_cutoff``.
+
+    Returns a single-precision :py:class:`scipy.sparse.csr_matrix`.
+    """
+    dim1 = len(queries)
+    dim2 = len(choices)
+    # float32 scores, int64 partition indexes and boolean masks per cell
+    chunk = max(1, max_memory // (16 * dim2)) if max_memory else dim1
+    data = []
+    indices = []
+    indptr = [np.zeros(1, dtype=np.int64)]
+    for beg in range(0, dim1, chunk):
+        block = cdist(queries[beg:beg + chunk], choices, score_cutoff=score_cutoff,
+                      dtype=np.float32, **kwargs)
+        if topk < dim2:
+            keep = np.zeros(block.shape, dtype=bool)
+            np.put_along_axis(keep, np.argpartition(-block, topk - 1, axis=1)[:, :topk], True, axis=1)
+            if score_cutoff:
+                keep |= block >= score_cutoff
+        else:
+            keep = np.ones(block.shape, dtype=bool)
+        # (explicit zeros are kept, too)
+        rows, cols = np.nonzero(keep)
+        data.append(block[rows, cols])
+        indices.append(cols)
+        indptr.append(indptr[-1][-1] + np.cumsum(np.count_nonzero(keep, axis=1)))
+        del block, keep
+    return csr_matrix((np.concatenate(data), np.concatenate(indices), np.concatenate(indptr)),
+                      shape=(dim1, dim2))
+
+def ngrams(s, n=BLOCKING_NGRAM):
+    """Get the set of character n-grams of string ``s`` (or ``s`` itself if shorter)."""
+    return set(s[i:i + n] for i in range(max(1, len(s) - n + 1)))
+
+def ngram_candidates(queries, choices, min_overlap):
+    """Find plausible pairs among ``queries`` and ``choices`` via an inverted n-gram index.
+
+    Indexes the character n-grams of all choices, ignoring n-grams which
+    occur too often to be informative. Then, for each query, counts the
+    n-grams it shares with each choice. Pairs sharing at least a fraction
+    of ``min_overlap`` of the informative n-grams of the smaller string
+    become candidates. (Queries without informative n-grams are paired
+    with all choices.)
+
+    Returns a boolean :py:class:`scipy.sparse.csr_matrix` of candidates.
+    """
+    dim1 = len(queries)
+    dim2 = len(choices)
+    postings = {}
+    for ind2, choice in enumerate(choices):
+        for gram in ngrams(choice):
+            postings.setdefault(gram, []).append(ind2)
+    max_df = max(1, BLOCKING_DF_MAX * dim2)
+    postings = {gram: np.array(inds) for gram, inds in postings.items()
+                if len(inds) <= max_df}
+    sizes2 = np.zeros(dim2, dtype=int)
+    for inds in postings.values():
+        sizes2[inds] += 1
+    indices = []
+    indptr = [0]
+    for query in queries:
+        grams = [postings[gram] for gram in ngrams(query) if gram in postings]
+        if grams:
+            cols, counts = np.unique(np.concatenate(grams), return_counts=True)
+            cols = cols[counts >= min_overlap * np.minimum(len(grams), sizes2[cols])]
+        else:
+            cols = np.arange(dim2)
+        indices.append(cols)
+        indptr.append(indptr[-1] + len(cols))
+    indices = np.concatenate(indices)
+    return csr_matrix((np.ones(len(indices), dtype=bool), indices, indptr),
+                      shape=(dim1, dim2))
+
+def charbag_candidates(queries, choices, score_cutoff=None, topk=None, max_memory=None):
+    """Find plausible pairs among ``queries`` and ``choices`` via their character counts.
+
+    Builds sparse vectors of character unigram and bigram counts for all
+    strings, and multiplies them (in chunks of rows, using approximately
+    up to ``max_memory`` bytes each) to get an upper bound for the
+    Levenshtein similarity of each pair: d ≥ L - c1 and d ≥ (L - 1 - c2) / 2
+    for edit distance d, maximum length L and common unigrams c1 / bigrams c2
+    (where the product of square roots of counts bounds their multiset
+    intersection). Pairs which cannot reach ``score_cutoff`` are dropped.
+    If ``topk`` is given, then of the remaining pairs of each row, only keeps
+    the PREFILTER_TOPK_FACTOR times ``topk`` pairs with the most similar
+    bigram distribution (by cosine), which is not exact.
+
+    Returns a boolean :py:class:`scipy.sparse.csr_matrix` of candidates.
+    """
+    dim1 = len(queries)
+    dim2 = len(choices)
+    def charbags(grams):
+        vocab = {}
+        def vectors(strings):
+            rows = []
+            cols = []
+            counts = []
+            for ind, string in enumerate(strings):
+                bag = Counter(grams(string))
+                rows.extend([ind] * len(bag))
+                cols.extend(vocab.setdefault(gram, len(vocab)) for gram in bag)
+                counts.extend(bag.values())
+            return np.sqrt(counts), (rows, cols)
+        vectors1 = vectors(queries)
+        vectors2 = vectors(choices)
+        return (csr_matrix(vectors1, shape=(dim1, len(vocab))),
+                csr_matrix(vectors2, shape=(dim2, len(vocab))).T.tocsc())
+    unigrams1, unigrams2 = charbags(iter)
+    bigrams1, bigrams2 = charbags(lambda string: zip(string, string[1:]))
+    # few distinct characters: dense product is faster
+    unigrams1 = unigrams1.toarray()
+    unigrams2 = unigrams2.toarray()
+    lengths1 = np.array(list(map(len, queries)))
+    lengths2 = np.array(list(map(len, choices)))
+    # float64 bounds, products and lengths per cell
+    chunk = max(1, max_memory // (40 * dim2)) if max_memory else dim1
+    indices = []
+    indptr = [np.zeros(1, dtype=np.int64)]
+    for beg in range(0, dim1, chunk):
+        longest = np.maximum.outer(lengths1[beg:beg + chunk], lengths2)
+        empty = longest == 0
+        longest[empty] = 1
+        common2 = (bigrams1[beg:beg + chunk] @ bigrams2).toarray()
+        bound = np.minimum(unigrams1[beg:beg + chunk] @ unigrams2 / longest,
+                           (longest + 1 + common2) / (2 * longest))
+        bound[empty] = 1.0
+        if score_cutoff:
+            # (with some tolerance for rounding)
+            keep = bound >= score_cutoff - 1e-6
+        else:
+            keep = np.ones(bound.shape, dtype=bool)
+        if topk and topk * PREFILTER_TOPK_FACTOR < dim2:
+            # cosine similarity of (square roots of) bigram counts
+            cosine = common2 / np.sqrt(np.outer(np.maximum(1, lengths1[beg:beg + chunk] - 1),
+                                                np.maximum(1, lengths2 - 1)))
+            cosine[~keep] = -1
+            best = np.zeros(bound.shape, dtype=bool)
+            np.put_along_axis(best, np.argpartition(-cosine, topk * PREFILTER_TOPK_FACTOR - 1, axis=1)
+                              [:, :topk * PREFILTER_TOPK_FACTOR], True, axis=1)
+            keep &= best
+            del cosine, best
+        indices.append(np.nonzero(keep)[1])
+        indptr.append(indptr[-1][-1] + np.cumsum(np.count_nonzero(keep, axis=1)))
+        del bound, keep, longest, empty, common2
+    indices = np.concatenate(indices)
+    return csr_matrix((np.ones(len(indices), dtype=bool), indices, np.concatenate(indptr)),
+                      shape=(dim1, dim2))
+
+def cdist_pairs(queries, choices, candidates, topk=None, score_cutoff=None, **kwargs):
+    """Compute a sparse similarity matrix like :py:func:`rapidfuzz.process.cdist`.
+
+    Calculates scores only for the pairs stored in the ``candidates`` matrix
+    (in parallel, via :py:func:`rapidfuzz.process.cpdist`). If ``topk`` is
+    given, then keeps only the ``topk`` best scores of each row, plus all
+    scores at or above ``score_cutoff``.
+
+    Returns a single-precision :py:class:`scipy.sparse.csr_matrix`.
+    """
+    candidates = csr_matrix(candidates)
+    candidates.sort_indices()
+    rows = np.repeat(np.arange(candidates.shape[0]), np.diff(candidates.indptr))
+    cols = candidates.indices
+    scores = cpdist([queries[ind1] for ind1 in rows],
+                    [choices[ind2] for ind2 in cols],
+                    score_cutoff=score_cutoff, dtype=np.float32, **kwargs)
+    if topk:
+        keep = np.zeros(len(scores), dtype=bool)
+        for beg, end in zip(candidates.indptr[:-1], candidates.indptr[1:]):
+            if end - beg <= topk:
+                keep[beg:end] = True
+                continue
+            keep[beg + np.argpartition(-scores[beg:end], topk - 1)[:topk]] = True
+            if score_cutoff:
+                keep[beg:end] |= scores[beg:end] >= score_cutoff
+        rows, cols, scores = rows[keep], cols[keep], scores[keep]
+    # (explicit zeros are kept, too)
+    return csr_matrix((scores, (rows, cols)), shape=candidates.shape)
+
+def cdist_band(queries, choices, width, score_cutoff=None, **kwargs):
+    """Compute a sparse similarity matrix like :py:func:`rapidfuzz.process.cdist`.
+
+    Calculates scores only for pairs within ``width`` of the diagonal
+    (scaled to the matrix shape). Rows for which the best score is below
+    ``BAND_ACC_MIN`` get their band widened (doubling each time) until some
+    better match is found or the whole row has been computed.
+
+    Returns a single-precision :py:class:`scipy.sparse.csr_matrix`.
+    """
+    dim1 = len(queries)
+    dim2 = len(choices)
+    center = np.arange(dim1) * dim2 // dim1
+    # already computed pos:end columns (initially empty)
+    pos = center.copy()
+    end = center.copy()
+    best = np.zeros(dim1, dtype=np.float32)
+    rows = []
+    cols = []
+    scores = []
+    todo = np.arange(dim1)
+    while len(todo):
+        new_pos = np.maximum(0, center[todo] - width)
+        new_end = np.minimum(dim2, center[todo] + width + 1)
+        # extend to the left and right
+        for begs, ends in [(new_pos, pos[todo]), (end[todo], new_end)]:
+            lengths = ends - begs
+            newrows = np.repeat(todo, lengths)
+            newcols = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths - begs, lengths)
+            newscores = cpdist([queries[ind1] for ind1 in newrows],
+                               [choices[ind2] for ind2 in newcols],
+                               score_cutoff=score_cutoff, dtype=np.float32, **kwargs)
+            np.maximum.at(best, newrows, newscores)
+            rows.append(newrows)
+            cols.append(newcols)
+            scores.append(newscores)
+        pos[todo] = new_pos
+        end[todo] = new_end
+        todo = todo[(best[todo] < BAND_ACC_MIN) & ((new_pos > 0) | (new_end < dim2))]
+        width *= 2
+    # (explicit zeros are kept, too)
+    return csr_matrix((np.concatenate(scores), (np.concatenate(rows), np.concatenate(cols))),
+                      shape=(dim1, dim2))
+
+def smith_waterman(queries, target, processor=None):
+    """Find the best local alignment of each query within target.
+
+    Calculates Smith-Waterman alignments with unit costs (+1 for matches,
+    -1 for mismatches and gaps) for all queries in a single pass: iterates
+    over query positions, vectorized over queries and target positions
+    (resolving gaps in the target by a prefix-maximum scan).
+
+    Returns scores (normalized by query length) and start and end
+    positions in target as a tuple of Numpy arrays.
+    """
+    if processor:
+        queries = [processor(query) for query in queries]
+        target = processor(target)
+    num = len(queries)
+    lens1 = np.array(list(map(len, queries)), dtype=int)
+    len2 = len(target)
+    codes1 = -1 * np.ones((num, max(lens1, default=0)), dtype=np.int32)
+    for ind, query in enumerate(queries):
+        codes1[ind, :len(query)] = list(map(ord, query))
+    codes2 = np.array(list(map(ord, target)), dtype=np.int32)
+    pos2 = np.arange(len2 + 1, dtype=np.int32)
+    # alignment scores and start positions in the previous row
+    # (column 0 and row 0 being the boundary)
+    score = np.zeros((num, len2 + 1), dtype=np.int32)
+    start = np.tile(pos2, (num, 1))
+    new = np.zeros_like(score)
+    new_start = np.zeros_like(start)
+    best = np.zeros(num, dtype=np.int32)
+    best_start = np.zeros(num, dtype=np.int32)
+    best_end = np.zeros(num, dtype=np.int32)
+    for code1, valid in zip(codes1.T, (codes1 >= 0).T):
+        # match/mismatch, gap in target or restart
+        diag = score[:, :-1] + 2 * (code1[:, np.newaxis] == codes2) - 1
+        vert = score[:, 1:] - 1
+        np.maximum(diag, vert, out=new[:, 1:])
+        np.maximum(new, 0, out=new)
+        new_start[:, 1:] = np.where(diag >= vert, start[:, :-1], start[:, 1:])
+        np.copyto(new_start, pos2, where=new == 0)
+        # gap in query (scanning from the left)
+        scan = new + pos2
+        scanmax = np.maximum.accumulate(scan, axis=1)
+        scanpos = np.maximum.accumulate((scan == scanmax) * pos2, axis=1)
+        new_score = scanmax - pos2
+        new_start = np.take_along_axis(new_start, scanpos, axis=1)
+        end = np.argmax(new_score, axis=1)[:, np.newaxis]
+        new_best = np.take_along_axis(new_score, end, axis=1)[:, 0]
+        better = valid & (new_best > best)
+        best[better] = new_best[better]
+        best_start[better] = np.take_along_axis(new_start, end, axis=1)[better, 0]
+        best_end[better] = end[better, 0]
+        if valid.all():
+            score, start = new_score, new_start
+        else:
+            score[valid] = new_score[valid]
+            start[valid] = new_start[valid]
+        new_start = np.zeros_like(start)
+    return best / np.maximum(1, lens1), best_start, best_end
+
+def assign_optimal(dist, length):
+    """Find the assignment with maximum sum of length-weighted similarity.
+
+    Solves the linear assignment problem for ``dist`` (dense or sparse,
+    with zero meaning incompatible) times ``length`` of the l2 strings
+    in one shot. As a (weak) monotonicity regularizer, pairs closer to
+    the diagonal gain up to DIAGONAL_BONUS more – which mostly decides
+    between (near) ties like repeated strings.
+
+    Returns l1 and l2 indices of all assigned pairs as Numpy arrays.
+    """
+    dim1, dim2 = dist.shape
+    def gain(ind1, ind2, score):
+        diagonal = 1.0 - np.abs(ind1 / dim1 - ind2 / dim2)
+        return score * length[ind2] * (1.0 + DIAGONAL_BONUS * diagonal)
+    if not issparse(dist):
+        ind1, ind2 = np.indices(dist.shape, sparse=True)
+        ind1, ind2 = linear_sum_assignment(gain(ind1, ind2, np.maximum(dist, 0)), maximize=True)
+        return ind1, ind2
+    dist = dist.tocoo()
+    ind1, ind2, score = dist.row, dist.col, dist.data
+    valid = score > 0
+    ind1, ind2, score = ind1[valid], ind2[valid], gain(ind1[valid], ind2[valid], score[valid])
+    # sparse matching must cover all rows, so add a dummy column for each;
+    # costs must be positive: cost(pair) = offset - gain(pair), cost(dummy) = offset
+    offset = 1.0 + (score.max() if len(score) else 0.0)
+    cost = csr_matrix((np.concatenate([offset - score, np.full(dim1, offset)]),
+                       (np.concatenate([ind1, np.arange(dim1)]),
+                        np.concatenate([ind2, dim2 + np.arange(dim1)]))),
+                      shape=(dim1, dim2 + dim1))
+    ind1, ind2 = min_weight_full_bipartite_matching(cost)
+    real = ind2 < dim2
+    return ind1[real], ind2[real]
+
+def assign_monotone(dist, length, splits=()):
+    """Find the monotone alignment with maximum sum of length-weighted similarity.
+
+    Runs a dynamic program over ``dist`` (dense or sparse, with zero meaning
+    incompatible) like Needleman-Wunsch over strings: each step either skips
+    an l1 string, skips an l2 string, or pairs them, gaining their similarity
+    times ``length`` of the l2 string. If given, ``splits`` holds similarity
+    matrices of the concatenations of 2, 3 ... consecutive l1 strings (with
+    row i for l1[i:i+2], l1[i:i+3] ...), allowing to pair such groups with one
+    l2 string, too.
+
+    For sparse matrices, only visits cells in a window around the stored
+    positive scores of each row (i.e. O(N·w) for a band of width w instead
+    of O(N·M)).
+
+    Returns a list of l1 index ranges and their l2 index (begin, end, ind2).
+    """
+    dim1, dim2 = dist.shape
+    gains = [dist] + list(splits)
+    size_max = len(gains)
+    if issparse(dist):
+        gains = [csr_matrix(matrix) for matrix in gains]
+        dist = gains[0].tocoo()
+        valid = dist.data > 0
+        rows, cols = dist.row[valid], dist.col[valid]
+        # columns of the dynamic program (0..dim2) to visit for each row (0..dim1):
+        # pairs leave row ind1 at column ind2 and enter row ind1+1 at column ind2+1
+        lo = np.full(dim1 + 1, dim2, dtype=int)
+        hi = np.zeros(dim1 + 1, dtype=int)
+        np.minimum.at(lo, rows, cols)
+        np.minimum.at(lo, rows + 1, cols + 1)
+        np.maximum.at(hi, rows, cols + 1)
+        np.maximum.at(hi, rows + 1, cols + 2)
+        lo[0] = 0
+        hi[dim1] = dim2 + 1
+        # windows must be monotone and overlapping, so there always is a path
+        lo = np.minimum.accumulate(lo[::-1])[::-1]
+        hi[:-1] = np.maximum(hi[:-1], lo[1:] + 1)
+        hi = np.maximum.accumulate(hi)
+    else:
+        lo = np.zeros(dim1 + 1, dtype=int)
+        hi = np.full(dim1 + 1, dim2 + 1)
+    def window(matrix, row, beg, end):
+        # scores of one row in columns beg:end
+        if not issparse(matrix):
+            return matrix[row, beg:end]
+        out = np.zeros(end - beg, dtype=matrix.dtype)
+        cols = matrix.indices[matrix.indptr[row]:matrix.indptr[row + 1]]
+        data = matrix.data[matrix.indptr[row]:matrix.indptr[row + 1]]
+        inside = (cols >= beg) & (cols < end)
+        out[cols[inside] - beg] = data[inside]
+        return out
+    # best sums for the last size_max rows (within their window)
+    totals = {0: np.zeros(hi[0] - lo[0])}
+    # choice in each cell: 0 skips l2 string, 1.. pairs that many l1 strings, size_max+1 skips l1 string
+    moves = [np.zeros(hi[0] - lo[0], dtype=np.int8)]
+    for ind in range(1, dim1 + 1):
+        beg, end = lo[ind], hi[ind]
+        options = np.full((size_max + 1, end - beg), -np.inf)
+        prev_beg, prev_end = lo[ind - 1], hi[ind - 1]
+        options[size_max, :min(end, prev_end) - beg] = totals[ind - 1][beg - prev_beg:min(end, prev_end) - prev_beg]
+        for size in range(1, min(size_max, ind) + 1):
+            src_beg, src_end = lo[ind - size], hi[ind - size]
+            pos = max(beg, src_beg + 1)
+            pos_end = min(end, src_end + 1)
+            if pos >= pos_end:
+                continue
+            score = window(gains[size - 1], ind - size, pos - 1, pos_end - 1)
+            gain = np.where(score > 0, score * length[pos - 1:pos_end - 1], -np.inf)
+            options[size - 1, pos - beg:pos_end - beg] = (
+                totals[ind - size][pos - 1 - src_beg:pos_end - 1 - src_beg] + gain)
+        best = np.argmax(options, axis=0)
+        total = options[best, np.arange(end - beg)]
+        # skipping l2 strings means carrying over from the left
+        totals[ind] = np.maximum.accumulate(total)
+        moves.append(np.where(totals[ind] > total, 0, best + 1).astype(np.int8))
+        totals.pop(ind - size_max, None)
+    # backtrack from the end
+    result = []
+    ind1, ind2 = dim1, dim2
+    while ind1 > 0:
+        move = int(moves[ind1][ind2 - lo[ind1]])
+        if move == 0:
+            ind2 -= 1
+        elif move > size_max:
+            ind1 -= 1
+        else:
+            result.append((ind1 - move, ind1, ind2 - 1))
+            ind1 -= move
+            ind2 -= 1
+    return result[::-1]
+
+def split_positions(segs, target):
+    """Find where each of the consecutive strings ``segs`` lies within ``target``.
+
+    Globally aligns the concatenation of ``segs`` (joined by spaces) with
+    ``target``, and projects the boundaries of each.
+
+    Returns a list of begin and end positions in target.
+    """
+    ops = [op for op in opcodes(' '.join(segs), target) if op.src_end > op.src_start]
+    def project(pos):
+        for op in ops:
+            if op.src_start <= pos < op.src_end:
+                if op.tag == 'delete':
+                    return op.dest_start
+                return min(op.dest_start + pos - op.src_start, op.dest_end)
+        return len(target)
+    result = []
+    pos = 0
+    for seg in segs:
+        result.append((project(pos), project(pos + len(seg))))
+        pos += len(seg) + 1
+    return result
+
+def subseg_worthwhile(score, seg1, seg2):
+    """Whether a pair scores low enough to try splitting seg2 (see :py:func:`match_subseg`)."""
+    return (# not already very good alignment
+            score < SUBSEG_ACC_MAX and
+            # multiple words
+            ' ' in seg2 and
+            # long enough
+            len(seg2) > SUBSEG_LEN_MIN and
+            # seg2 a lot larger than seg1
+            len(seg2) - len(seg1) > SUBSEG_LEN_MIN / 2)
+
+def similarity_matrix(l1, l2, normalization=None, workers=1, previous=None):
+    """Compute the dense similarity matrix between l1 and l2 (without cutoff).
+
+    When previous is given, i.e. a tuple of l1, l2 and the similarity matrix
+    from an earlier call (with the same normalization), only computes rows and
+    columns for those strings which were inserted or edited since, and copies
+    the rest (even if moved).
+
+    Returns a single-precision Numpy array (for ``dist`` in :py:func:`match`).
+    """
+    normalize = get_normalizer(normalization)
+    l1n = list(map(normalize, l1))
+    l2n = list(map(normalize, l2))
+    if previous is None:
+        return cdist(l1n, l2n, scorer=normalized_similarity,
+                     workers=workers, dtype=np.float32)
+    prev_l1, prev_l2, prev_dist = previous
+    def reindex(prev, strings):
+        index = {string: ind for ind, string in enumerate(prev)}
+        return np.array([index.get(string, -1) for string in strings], dtype=int)
+    rows = reindex(prev_l1, l1)
+    cols = reindex(prev_l2, l2)
+    old1 = np.flatnonzero(rows >= 0)
+    old2 = np.flatnonzero(cols >= 0)
+    new1 = np.flatnonzero(rows < 0)
+    new2 = np.flatnonzero(cols < 0)
+    dist = np.zeros((len(l1), len(l2)), dtype=np.float32)
+    dist[np.ix_(old1, old2)] = prev_dist[np.ix_(rows[old1], cols[old2])]
+    if len(new1):
+        dist[new1] = cdist([l1n[ind1] for ind1 in new1], l2n, scorer=normalized_similarity,
+                           workers=workers, dtype=np.float32)
+    if len(old1) and len(new2):
+        dist[np.ix_(old1, new2)] = cdist([l1n[ind1] for ind1 in old1],
+                                         [l2n[ind2] for ind2 in new2],
+                                         scorer=normalized_similarity,
+                                         workers=workers, dtype=np.float32)
+    return dist
+
+def match(l1, l2, workers=1, normalization=None, cutoff=None, try_subseg=False, interactive=False,
+          lowmem=False, topk=None, max_memory=None, blocking=None, band=None, exact_subseg=False,
+          parallel=None, cache_dir=None, dist=None, method='greedy', prefilter=False, memo=None):
     """Force alignment of string lists.
 
     Computes string alignments between each pair among l1 and l2.
@@ -22,15 +856,78 @@ def match(l1, l2, workers=1, normalization=None, cutoff=None, try_subseg=False,
     the assigned result a mapping from l1 to l2.
     (Unmatched or cut off elements will be assigned -1.
      When subsegmentation is allowed, searches for subalignments
-     of suboptimal matches in l2, i.e. may assign multiple l1 segments.)
+     of suboptimal matches in l2, i.e. may assign multiple l1 segments.
+     When exact_subseg, uses true local alignments to find them.
+     Subalignments are computed on a single pool of workers for the
+     whole run, or on parallel if given - an active joblib.Parallel
+     context, which allows reusing it across calls. Their results are
+     kept for the whole run, or in memo if given - a dict, which allows
+     reusing them across calls on the same strings.)
 
     When interactive, prompts each subalignment or alignment pair
     before keeping it. Then continues if accepted, but skipts that pair
     otherwise.
 
+    When lowmem, uses single instead of double precision for scoring
+    (which saves memory on large inputs, but may change the order
+    among nearly equal pairs).
+
+    When topk is given, only keeps the topk best pairs for each l1 element
+    (plus any at or above cutoff) in a sparse matrix, computing alignments
+    in chunks of l1 (using up to max_memory bytes each). Pairs not kept
+    cannot be assigned.
+
+    When blocking is given, only computes alignments for pairs sharing
+    at least that fraction of character n-grams (and no others), which
+    is much faster on large inputs. (Lower values increase recall.)
+    Pairs not computed count as 0 (like dissimilar pairs without blocking),
+    unless topk is also given.
+
+    When band is given, only computes alignments for pairs within that
+    distance from the diagonal – widening it where no good match can be
+    found –, which is much faster on large inputs in mostly the same order.
+
+    When prefilter is true, only computes alignments for pairs which can
+    reach cutoff according to their character counts (and, if topk is given,
+    have the most similar character bigrams), which is much faster on large
+    inputs (see :py:func:`charbag_candidates`).
+
+    Of these sparse modes, topk can be combined with blocking or prefilter
+    (keeping only the topk best among the pairs computed), but band cannot
+    be combined with any of them, and blocking not with prefilter.
+
+    When cache_dir is given, stores similarity matrices there, and reuses
+    them when called with the same strings and scoring setup again.
+    (Dense matrices are shared across cutoffs.)
+
+    When dist is given, uses it as precomputed dense similarity matrix
+    (without cutoff) instead, e.g. from :py:func:`similarity_matrix`
+    (which can incrementally update that of an earlier call).
+
+    When method is 'optimal' instead of 'greedy', finds the assignment
+    with maximum sum of length-weighted scores in one shot (see
+    :py:func:`assign_optimal`), and only then applies cutoff (and
+    tries subsegmentation on the pairs scoring low). This is usually
+    faster than the iterative search, but cannot be interactive.
+
+    When method is 'monotone', finds the in-order alignment with
+    maximum sum of length-weighted scores by dynamic programming
+    (see :py:func:`assign_monotone`), which is much faster but
+    only works if both sides are in the same order. Subsegmentation
+    then means pairing up to SPLIT_SIZE_MAX consecutive l1 strings
+    with one l2 string.
+
     Returns corresponding list indices and match scores [0.0,1.0]
     as a tuple of Numpy arrays.
     """
+    if method not in ('greedy', 'optimal', 'monotone'):
+        raise ValueError("unknown alignment method '%s'" % method)
+    if interactive and method != 'greedy':
+        raise ValueError("interactive alignment requires method 'greedy'")
+    if band and (topk or blocking or prefilter):
+        raise ValueError("band cannot be combined with topk, blocking or prefilter")
+    if blocking and prefilter:
+        raise ValueError("blocking cannot be combined with prefilter")
     assert len(l1) > 0
     assert len(l2) > 0
     assert isinstance(l1[0], str)
@@ -51,20 +948,64 @@ def match(l1, l2, workers=1, normalization=None, cutoff=None, try_subseg=False,
     #    gets prioritised until new neighbours arrive)
     # FIXME: for maximal use (e.g. both page-wise and line-wise alignment), consider using coarser metrics than Levenshtein on larger sequences
     # FIXME: allow passing confidence input (larger OCR confidence - less permissable deviation)
-    def preprocess(s):
-        if isinstance(normalization, dict):
-            for pattern, replacement in normalization.items():
-                s = re.sub(pattern, replacement, s)
-        s = unicodedata.normalize('NFKC', s)
-        return s
-    dist = cdist(l1, l2, scorer=normalized_similarity, score_cutoff=cutoff,
-                 processor=preprocess, workers=workers)
+    # normalize only once for all scoring (but keep raw strings for heuristics)
+    normalize = get_normalizer(normalization)
+    l1n = list(map(normalize, l1))
+    l2n = list(map(normalize, l2))
+    dtype = np.float32 if lowmem else np.float64
+    if dist is not None:
+        # precomputed (dense, without cutoff)
+        dist = np.array(dist, dtype=np.float32)
+        cut_later = True
+    else:
+        prefilter = prefilter and (cutoff or topk)
+        sparse = band or blocking or topk or prefilter
+        if cache_dir:
+            cache = SimilarityCache(cache_dir)
+            # dense scores can still be cut off after loading
+            key = cache.key(l1n, l2n, scorer='Levenshtein.normalized_similarity',
+                            band=band, blocking=blocking, topk=topk,
+                            cutoff=cutoff if sparse else None,
+                            **(dict(prefilter=True) if prefilter else {}))
+            dist = cache.load(key)
+        if dist is None:
+            if band:
+                dist = cdist_band(l1n, l2n, band,
+                                  scorer=normalized_similarity, score_cutoff=cutoff,
+                                  workers=workers)
+            elif blocking:
+                dist = cdist_pairs(l1n, l2n, ngram_candidates(l1n, l2n, blocking),
+                                   topk=topk, scorer=normalized_similarity, score_cutoff=cutoff,
+                                   workers=workers)
+            elif prefilter:
+                dist = cdist_pairs(l1n, l2n, charbag_candidates(l1n, l2n, score_cutoff=cutoff, topk=topk,
+                                                                max_memory=max_memory),
+                                   topk=topk, scorer=normalized_similarity, score_cutoff=cutoff,
+                                   workers=workers)
+            elif topk:
+                dist = cdist_topk(l1n, l2n,
+                                  topk=topk, max_memory=max_memory,
+                                  scorer=normalized_similarity, score_cutoff=cutoff,
+                                  workers=workers)
+            else:
+                dist = cdist(l1n, l2n, scorer=normalized_similarity,
+                             score_cutoff=None if cache_dir else cutoff,
+                             workers=workers, dtype=np.float32)
+            if cache_dir:
+                cache.store(key, dist)
+        cut_later = cache_dir and not sparse
+    if cut_later and cutoff:
+        # single precision is ambiguous near cutoff, so recalculate there
+        # (exactly as it would have been cut off during calculation)
+        for ind1, ind2 in np.argwhere(np.abs(dist - cutoff) <= np.spacing(np.float32(cutoff))):
+            dist[ind1, ind2] = normalized_similarity(l1n[ind1], l2n[ind2], score_cutoff=cutoff)
+        dist[dist < cutoff] = 0
     dim1 = len(l1)
     dim2 = len(l2)
     idx1 = np.arange(dim1)
-    idx2 = np.arange(dim2)
     keep1 = np.ones(dim1, dtype=bool)
     keep2 = np.ones(dim2, dtype=bool)
+    mono = MonotonicityIndex(dim1, dim2)
     result = -1 * np.ones(dim1, dtype=int)
     if try_subseg:
         # result must also hold start and end pos
@@ -75,159 +1016,533 @@ def match(l1, l2, workers=1, normalization=None, cutoff=None, try_subseg=False,
     # normalized similarity favours short sequences, which are "easier" to align
     # but we want to start with longest matches, so multiply with sequence length
     scores = np.zeros(dim1, dtype=dist.dtype)
-    length = np.tile(list(map(len, l2)), (dim1, 1))
-    for _ in range(dim1):
-        # make efficient view of remaining indexes
-        distview = dist[np.ix_(keep1,keep2)]
-        if not distview.size:
-            break
-        # in addition to isolated match score, we want to prioritise new mappings that
-        # keep consistency with current mappings and local ordering on both sides, i.e.
-        # monotonicity in the neighbourhood of current mappings
-        monotonicity = np.zeros(dist.shape, dtype=bool)
-        prev_ind1, prev_ind2 = 0, 0
-        for ind1, ind2 in list(zip(np.flatnonzero(~keep1), result_idx[~keep1])) + [(dim1, dim2)]:
-            if (ind1 >= prev_ind1) == (ind2 >= prev_ind2):
-                monotonicity[prev_ind1:ind1, prev_ind2:ind2] = True
+    length = np.array(list(map(len, l2)))
+    # in addition to isolated match score, we want to prioritise new mappings that
+    # keep consistency with current mappings and local ordering on both sides, i.e.
+    # monotonicity in the neighbourhood of current mappings
+    with ExitStack() as stack:
+        if try_subseg and parallel is None:
+            # keep the same workers for all subsegmentations
+            parallel = stack.enter_context(joblib.Parallel(n_jobs=workers))
+        if try_subseg and memo is None:
+            # keep the same local alignments for all subsegmentations
+            memo = dict()
+        if method == 'monotone':
+            splits = []
+            for size in range(2, min(SPLIT_SIZE_MAX, dim1) + 1 if try_subseg else 0):
+                # similarity of concatenations of consecutive l1 strings
+                concat = [' '.join(l1n[ind1:ind1 + size]) for ind1 in range(dim1 - size + 1)]
+                if issparse(dist):
+                    # only where any of them has candidates
+                    candidates = csr_matrix(dist > 0)
+                    candidates = sum(candidates[pos:pos + dim1 - size + 1] for pos in range(size))
+                    splits.append(cdist_pairs(concat, l2n, candidates,
+                                              scorer=normalized_similarity, score_cutoff=cutoff,
+                                              workers=workers))
+                else:
+                    splits.append(cdist(concat, l2n, scorer=normalized_similarity, score_cutoff=cutoff,
+                                        workers=workers, dtype=np.float32))
+            for beg1, end1, ind2 in assign_monotone(dist, length, splits):
+                if end1 - beg1 == 1:
+                    result_idx[beg1] = ind2
+                    scores[beg1] = dist[beg1, ind2]
+                    continue
+                positions = split_positions(l1n[beg1:end1], l2n[ind2])
+                for ind1, (begin, end) in zip(range(beg1, end1), positions):
+                    result_idx[ind1] = ind2
+                    result_beg[ind1] = begin
+                    result_end[ind1] = end
+                    scores[ind1] = normalized_similarity(l1n[ind1], l2n[ind2][begin:end])
+            return result, scores
+        if method == 'optimal':
+            ind1s, ind2s = assign_optimal(dist, length)
+            if not len(ind1s):
+                pairscores = np.zeros(0, dtype=dist.dtype)
+            elif issparse(dist):
+                pairscores = dist[ind1s, ind2s].A1
+            else:
+                pairscores = dist[ind1s, ind2s]
+            valid = pairscores > 0
+            if cutoff:
+                valid &= pairscores >= cutoff
+            result_idx[ind1s[valid]] = ind2s[valid]
+            scores[ind1s[valid]] = pairscores[valid]
+            keep1[ind1s[valid]] = False
+            keep2[ind2s[valid]] = False
+            if not try_subseg:
+                return result, scores
+            # try splitting low-scoring pairs, longest first
+            for ind1, ind2, score in sorted(zip(ind1s, ind2s, pairscores),
+                                            key=lambda pair: -pair[2] * length[pair[1]]):
+                if result_idx[ind1] != ind2 and not keep1[ind1]:
+                    continue # already taken by another split
+                if not subseg_worthwhile(score, l1[ind1], l2[ind2]):
+                    continue
+                cand1 = keep1.copy()
+                cand1[ind1] = True
+                if issparse(dist):
+                    scoresfor2 = dist[:, [ind2]].toarray()[cand1, 0]
+                else:
+                    scoresfor2 = dist[cand1, ind2]
+                subseg = match_subseg(l1n, l2n[ind2], scoresfor2, idx1[cand1],
+                                      min_score=max(score, cutoff or 0),
+                                      workers=workers,
+                                      exact=exact_subseg,
+                                      parallel=parallel,
+                                      memo=memo)
+                if not len(subseg):
+                    continue
+                if result_idx[ind1] == ind2:
+                    result_idx[ind1] = -1
+                    scores[ind1] = 0
+                    keep1[ind1] = True
+                keep2[ind2] = False
+                for subind1, begin, end, subscore in subseg:
+                    result_idx[subind1] = ind2
+                    result_beg[subind1] = begin
+                    result_end[subind1] = end
+                    scores[subind1] = subscore
+                    keep1[subind1] = False
+            return result, scores
+        greedy = LazyGreedy(dist, length, mono, keep1, keep2, dtype=dtype,
+                            implicit_zeros=bool(blocking) and not topk)
+        for _ in range(dim1):
+            coverage = 1.0 - np.count_nonzero(keep1) / dim1 # sigmoid in nr of assigned idx1:
+            coverage = 0.5 / (1 + np.exp(5 * (0.5 - coverage)))
+            best = greedy.select(coverage)
+            if best is None:
+                break
+            ind1, ind2, score = best
+            seg1 = l1[ind1]
+            seg2 = l2[ind2]
+            # assignment must be new
+            assert result_idx[ind1] < 0
+            assert keep1[ind1]
+            assert keep2[ind2]
+            # try subsegmentation / splitting ind2
+            if try_subseg and subseg_worthwhile(score, seg1, seg2):
+                if issparse(dist):
+                    scoresfor2 = dist[:, [ind2]].toarray()[keep1, 0]
+                else:
+                    scoresfor2 = dist[keep1, ind2]
+                indxesfor2 = idx1[keep1]
+                subseg = match_subseg(l1n, l2n[ind2], scoresfor2, indxesfor2,
+                                      min_score=max(score, cutoff or 0),
+                                      workers=workers,
+                                      exact=exact_subseg,
+                                      parallel=parallel,
+                                      memo=memo)
             else:
-                monotonicity[prev_ind1:ind1, :] = False
-                monotonicity[:, ind2:prev_ind2] = False
-            prev_ind1, prev_ind2 = ind1, ind2
-        monotonicity = monotonicity[np.ix_(keep1, keep2)]
-        coverage = 1.0 - monotonicity.shape[0] / dim1 # sigmoid in nr of assigned idx1:
-        coverage = 0.5 / (1 + np.exp(5 * (0.5 - coverage)))
-        lengthview = length[np.ix_(keep1,keep2)]
-        # score = (similarity [0.0-1.0] + monotonicity [0,] * coverage [0.0-0.5]) * length
-        priority = (distview + coverage * monotonicity) * lengthview
-        ind1, ind2 = np.unravel_index(np.argmax(priority, axis=None), priority.shape)
-        scoresfor2 = distview[:,ind2] # for subseg below
-        indxesfor2 = idx1[keep1] # for subseg below
-        score = distview[ind1,ind2]
-        # return to full view and assign next
-        ind1 = idx1[keep1][ind1]
-        ind2 = idx2[keep2][ind2]
-        seg1 = l1[ind1]
-        seg2 = l2[ind2]
-        # assignment must be new
-        assert result_idx[ind1] < 0
-        assert keep1[ind1]
-        assert keep2[ind2]
-        # try subsegmentation / splitting ind2
-        if (try_subseg and
-            # not already very good alignment
-            score < SUBSEG_ACC_MAX and
-            # multiple words
-            ' ' in seg2 and
-            # long enough
-            len(seg2) > SUBSEG_LEN_MIN and
-            # seg2 a lot larger than seg1
-            len(seg2) - len(seg1) > SUBSEG_LEN_MIN / 2):
-            subseg = match_subseg(l1, seg2, scoresfor2, indxesfor2,
-                                  min_score=max(score, cutoff or 0),
-                                  workers=workers,
-                                  processor=preprocess)
-        else:
-            subseg = []
-        if len(subseg):
-            accept = not interactive or click.prompt("Found subsegmentation:\n" +
-                                  "".join("%d/%d[%d:%d] (%.2f)\n> %s\n< %s\n" % (
-                                      subind1, ind2, begin, end, subscore, l1[subind1], seg2[begin:end])
-                                          for subind1, begin, end, subscore
-                                          in sorted(subseg, key=lambda sub:sub[1])) +
-                                                     "Accept", prompt_suffix='? ',
-                                                     type=bool, default=True, err=True)
-            if not accept:
                 subseg = []
-        if not len(subseg):
-            accept = not interactive or click.prompt("Found %d/%d (%.2f):\n> %s\n< %s\nAccept" % (
-                ind1, ind2, score, seg1, seg2), prompt_suffix='? ', type=bool, default=True, err=True)
-            if not accept:
-                dist[ind1,ind2] = -np.inf # skip next time
-                continue
-            if cutoff and score < cutoff:
-                if not try_subseg:
-                    # without subsegmentation, follow-up results will only be worse
-                    break
-                # we did try subsegmentation here already (all l1 for ind2)
-                keep2[ind2] = False # don't try again
+            if len(subseg):
+                accept = not interactive or click.prompt("Found subsegmentation:\n" +
+                                      "".join("%d/%d[%d:%d] (%.2f)\n> %s\n< %s\n" % (
+                                          subind1, ind2, begin, end, subscore, l1[subind1], seg2[begin:end])
+                                              for subind1, begin, end, subscore
+                                              in sorted(subseg, key=lambda sub:sub[1])) +
+                                                         "Accept", prompt_suffix='? ',
+                                                         type=bool, default=True, err=True)
+                if not accept:
+                    subseg = []
+            if not len(subseg):
+                accept = not interactive or click.prompt("Found %d/%d (%.2f):\n> %s\n< %s\nAccept" % (
+                    ind1, ind2, score, seg1, seg2), prompt_suffix='? ', type=bool, default=True, err=True)
+                if not accept:
+                    dist[ind1,ind2] = -np.inf # skip next time
+                    continue
+                if cutoff and score < cutoff:
+                    if not try_subseg:
+                        # without subsegmentation, follow-up results will only be worse
+                        break
+                    # we did try subsegmentation here already (all l1 for ind2)
+                    keep2[ind2] = False # don't try again
+                    continue
+                result_idx[ind1] = ind2
+                scores[ind1] = score
+                keep1[ind1] = False
+                keep2[ind2] = False
+                for beg1, end1 in mono.add(ind1, ind2):
+                    greedy.touch(beg1, end1)
+            else:
+                keep2[ind2] = False
+                for subind1, begin, end, subscore in subseg:
+                    result_idx[subind1] = ind2
+                    result_beg[subind1] = begin
+                    result_end[subind1] = end
+                    scores[subind1] = subscore
+                    keep1[subind1] = False
+                    for beg1, end1 in mono.add(subind1, ind2):
+                        greedy.touch(beg1, end1)
+    return result, scores
+
+def match_cutoffs(l1, l2, cutoffs, **kwargs):
+    """Force alignment of string lists for multiple cutoffs at once.
+
+    Computes the (dense) similarity matrix only once, then runs the
+    assignment of :py:func:`match` on it for each of cutoffs.
+    (Results for a higher cutoff are not just a prefix of those for a
+    lower cutoff, because pairs below cutoff also lose their priority.)
+    Local alignments for subsegmentation are shared across cutoffs, too.
+
+    Takes the same keyword arguments as :py:func:`match`, except dist
+    and those for sparse matrices (topk, blocking, band and prefilter),
+    which depend on cutoff. If cache_dir is given, the dense matrix is
+    shared with :py:func:`match`.
+
+    Returns a list of results of :py:func:`match`, one for each cutoff.
+    """
+    sparse = [name for name in ['topk', 'blocking', 'band', 'prefilter'] if kwargs.get(name, None)]
+    if sparse:
+        raise ValueError("cannot match multiple cutoffs at once with %s" % ", ".join(sparse))
+    normalization = kwargs.get('normalization', None)
+    cache_dir = kwargs.pop('cache_dir', None)
+    dist = None
+    if cache_dir:
+        cache = SimilarityCache(cache_dir)
+        normalize = get_normalizer(normalization)
+        # same key as the dense matrix in match
+        key = cache.key(list(map(normalize, l1)), list(map(normalize, l2)),
+                        scorer='Levenshtein.normalized_similarity',
+                        band=None, blocking=None, topk=None, cutoff=None)
+        dist = cache.load(key)
+    if dist is None:
+        dist = similarity_matrix(l1, l2, normalization=normalization,
+                                 workers=kwargs.get('workers', 1))
+        if cache_dir:
+            cache.store(key, dist)
+    # subsegmentation candidates do not depend on cutoff
+    kwargs.setdefault('memo', dict())
+    return [match(l1, l2, cutoff=cutoff, dist=dist, **kwargs)
+            for cutoff in cutoffs]
+
+def match_blocks(l1, l2, blocks1, blocks2, **kwargs):
+    """Force alignment of string lists, coarse to fine.
+
+    Groups the strings of l1 and l2 into blocks (e.g. text regions or
+    paragraphs) by their labels in blocks1 and blocks2, and aligns these
+    blocks first, by the similarity of their concatenated strings. Then
+    aligns strings only within each pair of matching blocks, which is much
+    cheaper than aligning all of them at once. Finally aligns all strings
+    left unassigned (in unmatched blocks, or without match in their block)
+    globally.
+
+    Takes the same keyword arguments as :py:func:`match` (except dist),
+    and returns the same.
+    """
+    assert len(l1) == len(blocks1)
+    assert len(l2) == len(blocks2)
+    # share local alignments for subsegmentation across blocks
+    kwargs.setdefault('memo', dict())
+    def group(blocks):
+        groups = {}
+        for ind, block in enumerate(blocks):
+            groups.setdefault(block, []).append(ind)
+        return list(groups.values())
+    groups1 = group(blocks1)
+    groups2 = group(blocks2)
+    try_subseg = kwargs.get('try_subseg', False)
+    dim1 = len(l1)
+    result = -1 * np.ones(dim1, dtype=int)
+    if try_subseg:
+        result = np.tile(result, (3, 1))
+        result_idx = result[0]
+    else:
+        result_idx = result
+    scores = np.zeros(dim1, dtype=np.float32)
+    def assign(inds1, inds2):
+        inds1 = np.array(inds1)
+        inds2 = np.array(inds2)
+        res, dst = match([l1[ind1] for ind1 in inds1], [l2[ind2] for ind2 in inds2], **kwargs)
+        if try_subseg:
+            # start and end pos
+            result[1:, inds1] = res[1:]
+            res = res[0]
+        matched = res >= 0
+        result_idx[inds1[matched]] = inds2[res[matched]]
+        scores[inds1[matched]] = dst[matched]
+    if len(groups1) > 1 or len(groups2) > 1:
+        block_res, _ = match(['\n'.join(l1[ind1] for ind1 in inds1) for inds1 in groups1],
+                             ['\n'.join(l2[ind2] for ind2 in inds2) for inds2 in groups2],
+                             workers=kwargs.get('workers', 1),
+                             normalization=kwargs.get('normalization', None),
+                             cutoff=BLOCK_ACC_MIN)
+        for block1, block2 in enumerate(block_res):
+            if block2 >= 0:
+                assign(groups1[block1], groups2[block2])
+    left1 = np.flatnonzero(result_idx < 0)
+    left2 = np.setdiff1d(np.arange(len(l2)), result_idx)
+    if len(left1) and len(left2):
+        assign(left1, left2)
+    return result, scores
+
+def anchor_pairs(l1, l2, processor=None):
+    """Find high-confidence pairs among l1 and l2 to split the alignment problem.
+
+    Hashes the strings (after applying ``processor``, ignoring whitespace
+    and case), and takes all pairs of strings which occur exactly once on
+    either side (and are at least ANCHOR_LEN_MIN long). Among these, keeps
+    the longest in-order chain (via patience sorting).
+
+    Returns a list of l1 and l2 indices (ind1, ind2), in order.
+    """
+    def keys(strings):
+        index = {}
+        for ind, string in enumerate(strings):
+            if processor:
+                string = processor(string)
+            key = ''.join(string.split()).casefold()
+            if len(key) < ANCHOR_LEN_MIN:
                 continue
-            result_idx[ind1] = ind2
-            scores[ind1] = score
-            keep1[ind1] = False
-            keep2[ind2] = False
+            # remember only the first index, but count all
+            index[key] = (index[key][0], -1) if key in index else (ind, ind)
+        return {key: ind for key, (ind, unique) in index.items() if unique >= 0}
+    keys2 = keys(l2)
+    pairs = sorted((ind1, keys2[key]) for key, ind1 in keys(l1).items() if key in keys2)
+    return increasing_chain(pairs)
+
+def increasing_chain(pairs):
+    """Find the longest chain of pairs which is monotonic on both sides.
+
+    Given a list of index pairs (ind1, ind2) sorted by ind1 (with unique ind1),
+    keeps the longest subsequence where ind2 does not decrease either (via
+    patience sorting).
+
+    Returns that subsequence as a list.
+    """
+    # longest increasing subsequence of ind2 (in order of ind1)
+    tails = [] # smallest ind2 ending a chain of each length
+    tails_pos = [] # position in pairs of that
+    preds = [] # position in pairs of predecessor in chain
+    for pos, (ind1, ind2) in enumerate(pairs):
+        length = bisect(tails, ind2)
+        preds.append(tails_pos[length - 1] if length else -1)
+        if length == len(tails):
+            tails.append(ind2)
+            tails_pos.append(pos)
         else:
-            keep2[ind2] = False
-            for subind1, begin, end, subscore in subseg:
-                result_idx[subind1] = ind2
-                result_beg[subind1] = begin
-                result_end[subind1] = end
-                scores[subind1] = subscore
-                keep1[subind1] = False
+            tails[length] = ind2
+            tails_pos[length] = pos
+    chain = []
+    pos = tails_pos[-1] if tails_pos else -1
+    while pos >= 0:
+        chain.append(pairs[pos])
+        pos = preds[pos]
+    return chain[::-1]
+
+def match_anchored(l1, l2, **kwargs):
+    """Force alignment of (long) string lists, split at anchors.
+
+    Finds anchors – strings occurring exactly once on both sides,
+    in order (see :py:func:`anchor_pairs`) – and pairs them. Then aligns
+    the strings between each consecutive pair of anchors independently
+    of the others, running these sub-problems in parallel on ``workers``.
+    (So cost is roughly linear in the number of strings, as long as there
+    are enough anchors. But pairs across anchors cannot be found.)
+
+    Takes the same keyword arguments as :py:func:`match` (except dist
+    and parallel), and returns the same.
+    """
+    workers = kwargs.pop('workers', 1)
+    kwargs.pop('parallel', None)
+    try_subseg = kwargs.get('try_subseg', False)
+    normalize = get_normalizer(kwargs.get('normalization', None))
+    dim1 = len(l1)
+    dim2 = len(l2)
+    result = -1 * np.ones(dim1, dtype=int)
+    if try_subseg:
+        result = np.tile(result, (3, 1))
+        result_idx = result[0]
+    else:
+        result_idx = result
+    scores = np.zeros(dim1, dtype=np.float32)
+    anchors = anchor_pairs(l1, l2, processor=normalize)
+    problems = []
+    end1, end2 = 0, 0
+    for ind1, ind2 in anchors + [(dim1, dim2)]:
+        if ind1 > end1 and ind2 > end2:
+            problems.append((end1, ind1, end2, ind2))
+        if ind1 < dim1:
+            result_idx[ind1] = ind2
+            scores[ind1] = normalized_similarity(normalize(l1[ind1]), normalize(l2[ind2]))
+        end1, end2 = ind1 + 1, ind2 + 1
+    if kwargs.get('interactive', False):
+        workers = 1
+    # many small problems: parallelize over batches of problems of similar cost
+    costs = np.cumsum([(end1 - beg1) * (end2 - beg2) for beg1, end1, beg2, end2 in problems])
+    splits = np.searchsorted(costs, costs[-1] * np.arange(1, workers) / workers) if len(costs) else []
+    def consume(batch):
+        return [match(l1[beg1:end1], l2[beg2:end2], **kwargs)
+                for beg1, end1, beg2, end2 in batch]
+    results = joblib.Parallel(n_jobs=workers)(
+        joblib.delayed(consume)(batch)
+        for batch in np.split(np.array(problems, dtype=int).reshape(-1, 4), splits))
+    for (beg1, end1, beg2, end2), (res, dst) in zip(problems, chain.from_iterable(results)):
+        if try_subseg:
+            # start and end pos
+            result[1:, beg1:end1] = res[1:]
+            res = res[0]
+        matched = res >= 0
+        result_idx[beg1:end1][matched] = beg2 + res[matched]
+        scores[beg1:end1][matched] = dst[matched]
     return result, scores
 
-def match_subseg(l1, seg2, scoresfor2, indxesfor2, min_score=0, workers=1, processor=None):
-    """look at all possible matches of seg2 per local alignment and find a set of mutually compatible subsegmentation"""
+def find_window(l1, l2, begin=0, end=None, normalization=None, workers=1):
+    """Find the range of strings in l2 which l1 corresponds to.
+
+    Compares all strings of l1 with those of ``l2[begin:end]`` (e.g. the lines
+    of a page with the surrounding part of the lines of a book), and takes the
+    best match of each string in l1 if it scores at least WINDOW_ACC_MIN.
+    Among these, finds the longest in-order chain, and extends the range
+    it covers by as many strings as are missing on the l1 side before and
+    after it. Also includes all other matches up to ``len(l1)`` away from
+    that (so local reordering is tolerated, but outliers like repeated
+    strings elsewhere get ignored). Finally, adds WINDOW_MARGIN on both sides.
+
+    Returns the l2 indices (begin, end) of the window, or None if nothing
+    could be found in the given range.
+    """
+    if end is None:
+        end = len(l2)
+    begin = max(0, begin)
+    end = min(len(l2), end)
+    if not len(l1) or begin >= end:
+        return None
+    normalize = get_normalizer(normalization)
+    l1n = list(map(normalize, l1))
+    l2n = list(map(normalize, l2[begin:end]))
+    dist = cdist(l1n, l2n, scorer=normalized_similarity,
+                 score_cutoff=WINDOW_ACC_MIN, dtype=np.float32, workers=workers)
+    best = dist.argmax(axis=1)
+    pairs = [(ind1, ind2) for ind1, ind2 in enumerate(best)
+             if dist[ind1, ind2] >= WINDOW_ACC_MIN]
+    chain = increasing_chain(pairs)
+    if not chain:
+        return None
+    (first1, first2), (last1, last2) = chain[0], chain[-1]
+    first2 -= first1
+    last2 += len(l1) - last1
+    inds2 = [ind2 for _, ind2 in pairs
+             if first2 - len(l1) <= ind2 < last2 + len(l1)]
+    first2 = min(first2, min(inds2))
+    last2 = max(last2, max(inds2) + 1)
+    return (max(0, begin + first2 - WINDOW_MARGIN),
+            min(len(l2), begin + last2 + WINDOW_MARGIN))
+
+def subseg_path(spans, len2):
+    """Find the best global sequence of local alignments spanning a string of length ``len2``.
+
+    Given ``spans`` as a dict mapping start and end position to alignment
+    distance and l1 index, finds the shortest path from 0 to len2 via these
+    spans and gaps (deletions forward or overlaps backward, costing their
+    length). Any span ending before the previous end can be skipped without
+    extra cost, so it suffices to go left to right by end position.
+
+    (This has the same total distance as the shortest path through the dense
+     (len2+1)^2 matrix of spans and gaps used before, but among equally short
+     paths, it may choose another one. Also, unlike the sparse conversion of
+     that matrix, it keeps spans with zero distance, i.e. exact alignments.)
+
+    Returns the total distance and the path as list of l1 index, start and
+    end position and score.
+    """
+    spans = sorted((end, start, subdst1, subind1)
+                   for (start, end), (subdst1, subind1) in spans.items())
+    ends = np.array([span[0] for span in spans], dtype=int)
+    costs = np.zeros(len(spans)) # shortest distance up to end of each span
+    preds = -1 * np.ones(len(spans), dtype=int) # previous span on that path
+    for i, (end, start, subdst1, _) in enumerate(spans):
+        cost = start # forward gap from 0
+        # all spans ending strictly before this one
+        prev = np.searchsorted(ends, end)
+        if prev:
+            via = costs[:prev] + np.abs(start - ends[:prev])
+            pred = np.argmin(via)
+            if via[pred] < cost:
+                cost = via[pred]
+                preds[i] = pred
+        costs[i] = cost + subdst1
+    total = len2 # forward gap from 0 to len2
+    last = -1
+    if len(spans):
+        via = costs + len2 - ends
+        pred = np.argmin(via)
+        if via[pred] < total:
+            total = via[pred]
+            last = pred
+    path = []
+    while last >= 0:
+        end, start, subdst1, subind1 = spans[last]
+        path.append((subind1, start, end, 1.0 - subdst1 / (end - start)))
+        last = preds[last]
+    return total, list(reversed(path))
+
+def match_subseg(l1, seg2, scoresfor2, indxesfor2, min_score=0, workers=1, processor=None, exact=False,
+                 parallel=None, memo=None):
+    """look at all possible matches of seg2 per local alignment and find a set of mutually compatible subsegmentation
+
+    (If memo is given, a dict, then looks up and stores partial ratios and local
+     alignments of pairs of strings there, so repeated calls with the same
+     processor can skip them.)
+    """
     # FIXME: rapidfuzz partial_ratio is not really usable: it is an average over windows
     #        along the local alignment (which means its score will always be >40
     #        as long as bigrams keep matching, and the start:end pos will usually
-    #        not have any significant meaning); so we should use true Smith-Waterman here
+    #        not have any significant meaning); so if exact, use true Smith-Waterman here
     # more than 1 possible match of ind2
     if np.count_nonzero(scoresfor2 >= SUBSEG_ACC_MIN) < 2:
         return [] # global alignment is just too bad to begin with
     # -- first, get a fast overview of where to look for matches (in parallel, without the actual alignments)
+    if memo is None:
+        memo = dict()
     subinds = indxesfor2[scoresfor2 >= SUBSEG_ACC_MIN]
     subl1 = [l1[subind1] for subind1 in subinds]
     subl2 = [seg2]
-    subdist = cdist(subl1, subl2, scorer=partial_ratio, score_cutoff=PARTIAL_ACC_MIN,
-                    processor=processor, workers=workers)
+    ratios = memo.setdefault('partial_ratio', dict())
+    todo = list(dict.fromkeys(seg1 for seg1 in subl1 if (seg1, seg2) not in ratios))
+    if todo:
+        subdist = cdist(todo, subl2, scorer=partial_ratio, score_cutoff=PARTIAL_ACC_MIN,
+                        processor=processor, workers=workers)
+        ratios.update(((seg1, seg2), subscore) for seg1, subscore in zip(todo, subdist[:, 0]))
+    subdist = np.array([ratios[seg1, seg2] for seg1 in subl1])
     if np.count_nonzero(subdist >= PARTIAL_ACC_MIN) < 2:
         return [] # no (good) other matches available
-    # -- second, find the actual local alignment of the good candidates,
-    #            and prepare a new alignment matrix for all candidates
-    #            as complete subsegmentations of seg2
-    len2 = len(seg2) + 1
-    subscoresfor2 = np.inf * np.ones((len2, len2)) # alignment distances from l1 to seg2[start:end]
-    subindxesfor2 = -1 * np.ones((len2, len2), dtype=int) # alignment indices from l1 to seg2[start:end]
-    # prefill with deletion distances (because partial_ratio might skip some chars)
-    for i in range(len2):
-        for j in range(i + 1, len2):
-            subscoresfor2[i, j] = j - i # forward gap
-            subscoresfor2[j, i] = j - i # backward gap
-    def produce():
-        for subind1 in np.nonzero(subdist >= PARTIAL_ACC_MIN)[0]:
-            #subscore1 = subdist[subind1, 0]
-            subind1 = subinds[subind1]
-            seg1 = l1[subind1]
-            yield seg1, subind1
-    def consume(input_):
-        seg1, ind1 = input_
+    # -- second, find the actual local alignment of the good candidates
+    #            as partial subsegmentations of seg2
+    len2 = len(seg2)
+    spans = dict() # alignment distance and index from l1 for seg2[start:end]
+    subinds1 = subinds[np.nonzero(subdist >= PARTIAL_ACC_MIN)[0]]
+    def consume(seg1s):
         # zzz: ensure that seg1 is nearly complete
-        return partial_ratio_alignment(seg1, seg2, processor=processor), ind1
-    job = joblib.Parallel(n_jobs=workers)
-    for subscore, subind1 in job(joblib.delayed(consume)(item) for item in produce()):
-        subscore.dest_end = min(subscore.dest_end, len(seg2))
-        subdst1 = (1.0 - subscore.score / 100) * (subscore.dest_end - subscore.dest_start)
-        subscoresfor2[subscore.dest_start, subscore.dest_end] = subdst1
-        subindxesfor2[subscore.dest_start, subscore.dest_end] = subind1
-    # -- third, find the shortest path through the subsegmentation matrix,
-    #           i.e. the best global sequence of non-overlapping local alignments
-    subdist, subpath = shortest_path(csgraph=csr_matrix(subscoresfor2),
-                                     indices=0, return_predecessors=True)
+        return [partial_ratio_alignment(seg1, seg2, processor=processor) for seg1 in seg1s]
+    alignments = memo.setdefault('smith_waterman' if exact else 'partial_ratio_alignment', dict())
+    todo = list(dict.fromkeys(l1[subind1] for subind1 in subinds1 if (l1[subind1], seg2) not in alignments))
+    if todo and exact:
+        alignments.update(((seg1, seg2), subalignment) for seg1, subalignment in
+                          zip(todo, zip(*smith_waterman(todo, seg2, processor=processor))))
+    elif todo:
+        if parallel is None:
+            parallel = joblib.Parallel(n_jobs=workers)
+        # one batch per worker (so seg2 only needs to be passed once each)
+        batches = np.array_split(np.array(todo, dtype=object), min(max(1, workers), len(todo)))
+        job = parallel(joblib.delayed(consume)(list(batch))
+                       for batch in batches)
+        alignments.update(((seg1, seg2), (subscore.score / 100, subscore.dest_start, subscore.dest_end))
+                          for seg1, subscore in zip(todo, chain.from_iterable(job)))
+    subalignments = (alignments[l1[subind1], seg2] + (subind1,) for subind1 in subinds1)
+    for subscore, start, end, subind1 in subalignments:
+        end = min(end, len2)
+        if start >= end:
+            continue
+        subdst1 = (1.0 - subscore) * (end - start)
+        # (like the last one written into the dense matrix before)
+        if (start, end) not in spans or subdst1 <= spans[start, end][0]:
+            spans[start, end] = subdst1, subind1
+    # -- third, find the shortest path from 0 to len2 via local alignments
+    total, subresult = subseg_path(spans, len2)
     # convert to score again and check if better than single match
-    score = (len2 - subdist[-1]) / len2
+    score = (len2 + 1 - total) / (len2 + 1)
     if score <= min_score:
         return []
-    # follow up on best path
-    subresult = []
-    subpos = len2 - 1
-    while subpos > 0:
-        prepos = max(0, subpath[subpos])
-        subscore = subdist[subpos] - subdist[prepos]
-        subind = subindxesfor2[prepos, subpos]
-        if subind >= 0:
-            subresult.append((subind, prepos, subpos, 1.0 - subscore / (subpos - prepos)))
-        subpos = prepos
-    subresult = list(reversed(subresult))
     for i in range(len(subresult) - 1):
         subind1, beg1, end1, subscore1 = subresult[i]
         subind2, beg2, end2, subscore2 = subresult[i + 1]
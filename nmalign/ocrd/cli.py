@@ -1,24 +1,35 @@
 import os
 import re
 import json
-from itertools import chain
+import mmap
+import time
+import queue
+import threading
+from io import StringIO
+from contextlib import ExitStack
 from typing import Optional, List, Union, get_args
 import multiprocessing as mp
 
 import click
+import joblib
+import numpy as np
+from lxml import etree as ET
 
 from ocrd.decorators import ocrd_cli_options, ocrd_cli_wrap_processor
 from ocrd import Workspace, Processor, OcrdPageResult
+from ocrd.processor.base import NonUniqueInputFile, MissingInputFile
 from ocrd_models import OcrdPage, OcrdFileType
+from ocrd_models.constants import NAMESPACES, PAGE_REGION_TYPES
 from ocrd_models.ocrd_page import (
-    TextLineType,
+    PcGtsType,
+    MetadataType,
+    PageType,
+    TextRegionType,
     TextEquivType,
     RegionRefType,
     RegionRefIndexedType,
     OrderedGroupType,
     OrderedGroupIndexedType,
-    UnorderedGroupType,
-    UnorderedGroupIndexedType,
     to_xml,
 )
 from ocrd_models.ocrd_page_generateds import (
@@ -34,6 +45,7 @@ from ocrd_utils import (
 
 from ..lib import align
 
+NS = {'pc': NAMESPACES['page']}
 
 class NMAlignMerge(Processor):
 
@@ -45,6 +57,28 @@ class NMAlignMerge(Processor):
     def metadata_filename(self) -> str:
         return os.path.join('ocrd', 'ocrd-tool.json')
 
+    def setup(self):
+        self.workers = self.parameter['workers']
+        if not self.workers:
+            # share available cores with page-parallel processing
+            pages = config.OCRD_MAX_PARALLEL_PAGES
+            if 0 < self.max_workers < pages:
+                pages = self.max_workers
+            self.workers = max(1, joblib.cpu_count() // max(1, pages))
+        self.logger.debug("using %d workers per page", self.workers)
+        # (only set up for the whole workspace by process_workspace,
+        #  these defaults apply when processing single pages directly)
+        self.stats = AlignmentStats()
+        self.stats_queue = None
+        self.reader = None
+        self.writer = None
+        self.parallel = None
+        self.parallel_stack = ExitStack()
+
+    def shutdown(self):
+        self.parallel_stack.close()
+        self.parallel = None
+
     def zip_input_files(self, **kwargs):
         # overrides ocrd.Processor.zip_input_files, which cannot be used;
         # we actually want input with MIMETYPE_PAGE for the first grp
@@ -68,6 +102,22 @@ class NMAlignMerge(Processor):
             self._base_logger.debug(f"adding file {input_file.ID} for page {input_file.pageId} "
                                     f"from input file group {input_grp}")
             ift[0] = input_file
+        if self.parameter['book_text']:
+            # a single text/plain file for the whole document
+            book_files = [other_file for other_file in self.workspace.mets.find_all_files(
+                fileGrp=other_grp, mimetype='text/plain') if not other_file.pageId]
+            if len(book_files) > 1:
+                raise NonUniqueInputFile(other_grp, None, 'text/plain')
+            if not book_files:
+                raise MissingInputFile(other_grp, None, 'text/plain')
+            self._base_logger.debug(f"adding file {book_files[0].ID} for all pages "
+                                    f"from input file group {other_grp}")
+            # all pages of the document (not only those selected)
+            self.book_pages = list(self.workspace.mets.physical_pages)
+            self.book_ranks = {page: rank for rank, page in enumerate(self.book_pages)}
+            self.book_ends = {}
+            # process pages in physical order, so each can continue where the previous ended
+            return [(pages[page][0], book_files[0]) for page in sorted(pages, key=self.book_ranks.get)]
         mimetype = "//(%s|text/plain)" % re.escape(MIMETYPE_PAGE)
         for other_file in self.workspace.mets.find_all_files(
                 pageId=self.page_id, fileGrp=other_grp, mimetype=mimetype):
@@ -108,14 +158,70 @@ class NMAlignMerge(Processor):
         return ifts
 
     def process_workspace(self, workspace: Workspace) -> None:
-        self.stats = mp.Manager().dict(all_confs=[], all_match=0, all_total=0)
-        super().process_workspace(workspace)
-        if len(self.stats['all_confs']):
+        self.stats = AlignmentStats()
+        # page workers may be forked subprocesses, so each sends its page
+        # statistics once at the end (and we merge them as they arrive)
+        self.stats_queue = mp.get_context('fork').SimpleQueue()
+        listener = threading.Thread(target=self.stats.listen, args=(self.stats_queue,))
+        listener.start()
+        # pages processed sequentially in this process can be pipelined:
+        # read ahead and write behind in threads while aligning in between
+        self.reader = None
+        self.writer = None
+        pages = config.OCRD_MAX_PARALLEL_PAGES
+        if 0 < self.max_workers < pages:
+            pages = self.max_workers
+        if self.parameter['prefetch'] and pages <= 1:
+            self.writer = PageWriter(self.write_page_file, self.parameter['prefetch'], self.logger)
+        # one pool of workers for subsegmentation on all pages
+        # (opened on demand, i.e. in each page worker subprocess)
+        self.parallel = None
+        try:
+            super().process_workspace(workspace)
+        finally:
+            self.parallel_stack.close()
+            self.parallel = None
+            if self.reader:
+                self.reader.stop()
+                self.reader = None
+            if self.writer:
+                writer, self.writer = self.writer, None
+                writer.close()
+            self.stats_queue.put(None)
+            listener.join()
+            self.stats_queue = None
+        if self.stats.matched:
             self.logger.info("average alignment accuracy overall: %d%%",
-                             100 * sum(self.stats['all_confs']) / len(self.stats['all_confs']))
-        if self.stats['all_total']:
+                             100 * self.stats.confs / self.stats.matched)
+        if self.stats.lines:
             self.logger.info("coverage of matching lines overall: %d%%",
-                             100 * self.stats['all_match'] / self.stats['all_total'])
+                             100 * self.stats.matched / self.stats.lines)
+        if self.parameter['stats_file']:
+            stats_file = self.parameter['stats_file']
+            stats_file_id = self.output_file_grp + '_STATS'
+            if (config.OCRD_EXISTING_OUTPUT == 'SKIP' and
+                next(workspace.mets.find_files(ID=stats_file_id), None)):
+                self.logger.warning("not overwriting existing alignment statistics %s", stats_file_id)
+                return
+            self.logger.info("writing alignment statistics to %s", stats_file)
+            # document-global file of the output fileGrp
+            workspace.add_file(
+                file_id=stats_file_id,
+                file_grp=self.output_file_grp,
+                page_id=None,
+                local_filename=stats_file,
+                mimetype='application/json',
+                content=json.dumps(self.stats.to_json(), indent=2),
+                force=config.OCRD_EXISTING_OUTPUT == 'OVERWRITE',
+            )
+
+    def process_workspace_submit_tasks(self, executor, max_seconds):
+        tasks = super().process_workspace_submit_tasks(executor, max_seconds)
+        if self.writer:
+            # tasks will run in this order, so their inputs can be parsed ahead
+            self.reader = PageReader(self.read_page_files, [input_files for _, input_files in tasks.values()],
+                                     self.parameter['prefetch'])
+        return tasks
 
     def process_page_file(self, *input_files : Optional[OcrdFileType]) -> None:
         """Force-align the textlines text of both inputs for each page,
@@ -124,6 +230,12 @@ class NMAlignMerge(Processor):
         Find file pairs in both input file groups of the workspace
         for the same page IDs.
 
+        If ``book_text`` is true, then instead of plain text files for
+        each page, expect a single plain text file for the whole document
+        in the second fileGrp. Search for the window of its lines matching
+        the page (starting where the previous page ended), and only align
+        with these.
+
         Open and deserialize PAGE input files, then iterate over
         the element hierarchy down to the TextLine level, looking
         at each first TextEquiv. (If the second input has no TextLines,
@@ -132,14 +244,29 @@ class NMAlignMerge(Processor):
         that page.)
 
         Align character sequences in all pairs of lines for any
-        combination of textlines from either side.
+        combination of textlines from either side. (If ``band`` is
+        positive, then only compare lines up to that distance from
+        the diagonal, widening where no good match can be found.)
 
         If ``normalization`` is non-empty, then apply each of these regex
         replacements to both sides before comparison.
 
-        Then iteratively search the next closest match pair. Remember
+        Compute alignments with ``workers`` threads/processes per page
+        (or, if zero, with as many as cores are available for each of
+        the pages processed in parallel), keeping the same pool of
+        workers for all pages.
+
+        Then iteratively search the next closest match pair. (If ``method``
+        is ``optimal``, then find the pairs with maximum total score
+        in one shot instead. If ``method`` is ``monotone``, then find
+        the in-order alignment with maximum total score.) Remember
         the assigned result as mapping from first to second fileGrp.
 
+        If ``hierarchical`` is true, then align text regions first
+        (or, for plain text, paragraphs separated by empty lines),
+        and lines only within matching pairs of regions. Lines left
+        unmatched are then aligned across the whole page.
+
         When all lines of the second fileGrp have been assigned,
         or the ``cutoff_dist`` has been reached, apply the mapping
         by inserting each line from the second fileGrp into position
@@ -157,24 +284,33 @@ class NMAlignMerge(Processor):
         the single match when inserting results.
 
         Produce a new PAGE output file by serialising the resulting hierarchy.
+
+        If ``fast_xml`` is true, then instead of deserializing the PAGE
+        object model, only query the element trees of both inputs for
+        the TextLine level, and patch the new TextEquivs (and the text
+        of their regions) directly into the tree before serialising.
+        (This only supports the 2019 PAGE schema version. Inputs of any
+         other version are refused on the fast path.)
+
+        If ``prefetch`` is positive (and pages are processed sequentially),
+        then parse the input files of up to that many next pages in a
+        background thread while aligning this one, and serialize and write
+        the output files of up to that many previous pages in another.
+
+        Report alignment statistics per page and overall (and if
+        ``stats_file`` is non-empty, export them as JSON there, and
+        add that to the output fileGrp as a file without page ID,
+        replacing or keeping an existing one like the PAGE output files
+        under ``OCRD_EXISTING_OUTPUT=OVERWRITE`` or ``SKIP``).
         """
-        input_tuple : List[Optional[Union[OcrdPage,str]]] = [None] * len(input_files)
         page_id = input_files[0].pageId
+        page_start = time.perf_counter()
+        fast = self.parameter['fast_xml']
         self._base_logger.info("processing page %s", page_id)
-        for i, input_file in enumerate(input_files):
-            assert isinstance(input_file, get_args(OcrdFileType))
-            try:
-                if input_file.mimetype == MIMETYPE_PAGE:
-                    self._base_logger.debug(f"parsing file {input_file.ID} for page {page_id}")
-                    page_ = page_from_file(input_file)
-                    assert isinstance(page_, OcrdPage)
-                    input_tuple[i] = page_
-                else:
-                    self._base_logger.debug(f"reading file {input_file.ID} for page {page_id}")
-                    input_tuple[i] = input_file.local_filename
-            except ValueError as err:
-                # not PAGE and not an image to generate PAGE for
-                self._base_logger.error(f"non-PAGE input for page {page_id}: {err}")
+        if self.reader:
+            input_tuple = self.reader.get(page_id)
+        else:
+            input_tuple = self.read_page_files(*input_files)
         output_file_id = make_file_id(input_files[0], self.output_file_grp)
         output_file = next(self.workspace.mets.find_files(ID=output_file_id), None)
         if output_file and config.OCRD_EXISTING_OUTPUT != 'OVERWRITE':
@@ -185,109 +321,478 @@ class NMAlignMerge(Processor):
         input_file_grp, other_file_grp = self.input_file_grp.split(',')
 
         pcgts = input_tuple[0]
-        page = pcgts.get_Page()
-        lines = page.get_AllTextLines()
+        if fast:
+            page = xml_get_page(pcgts)
+            lines = xml_get_all_textlines(page)
+        else:
+            page = pcgts.get_Page()
+            lines = page.get_AllTextLines()
         if not len(lines):
             self.logger.warning("no text lines on page %s of 1st input", page_id)
             return
-        texts = list(map(page_element_unicode0, lines))
-        if isinstance(input_tuple[1], OcrdPage):
+        if fast:
+            line_ids = [line.get('id') for line in lines]
+            texts = list(map(xml_element_unicode0, lines))
+            # blocks of lines (for hierarchical alignment)
+            blocks = [line.getparent().get('id') for line in lines]
+        else:
+            line_ids = [line.id for line in lines]
+            texts = list(map(page_element_unicode0, lines))
+            # blocks of lines (for hierarchical alignment)
+            blocks = page_get_line_regions(page, lines)
+        if self.parameter['book_text']:
+            other_begin, other_texts = self.find_book_window(page_id, input_tuple[1], texts)
+            other_blocks = []
+            block = 0
+            for line in other_texts:
+                # paragraphs are separated by empty lines
+                if not line.strip():
+                    block += 1
+                other_blocks.append(block)
+            # number lines globally
+            other_ids = ["line%04d" % i for i in range(other_begin, other_begin + len(other_texts))]
+            book_lines = dict(zip(other_ids, range(other_begin, other_begin + len(other_texts))))
+        elif isinstance(input_tuple[1], tuple):
+            other_texts = []
+            other_blocks = []
+            block = 0
+            for _, other_content in sorted(input_tuple[1:]):
+                for line in other_content.splitlines():
+                    # paragraphs are separated by empty lines
+                    if not line.strip():
+                        block += 1
+                    other_texts.append(line)
+                    other_blocks.append(block)
+                block += 1
+            other_ids = ["line%04d" % i for i in range(len(other_texts))]
+        else:
             other_pcgts = input_tuple[1]
-            other_page = other_pcgts.get_Page()
-            other_lines = other_page.get_AllTextLines()
-            if len(other_lines):
-                other_texts = list(map(page_element_unicode0, other_lines))
+            if fast:
+                other_page = xml_get_page(other_pcgts)
+                other_lines = xml_get_all_textlines(other_page)
+                other_ids = [line.get('id') for line in other_lines]
+                other_texts = list(map(xml_element_unicode0, other_lines))
+                other_blocks = [line.getparent().get('id') for line in other_lines]
             else:
+                other_page = other_pcgts.get_Page()
+                other_lines = other_page.get_AllTextLines()
+                other_ids = [line.id for line in other_lines]
+                other_texts = list(map(page_element_unicode0, other_lines))
+                other_blocks = page_get_line_regions(other_page, other_lines)
+            if not len(other_lines):
                 # no textline level in 2nd input: try region level with newlines
                 self.logger.warning("no text lines on page %s for 2nd input, trying newline-separeted text regions", page_id)
                 # keep whole regions to be subsegmented,
                 # or split lines, or full page?
-                other_texts = list(chain.from_iterable([
-                    page_element_unicode0(region).split('\r\n')
-                    for region in other_page.get_AllRegions(classes=['Text'])]))
-        else:
-            other_texts = []
-            for other_filename in sorted(input_tuple[1:]):
-                with open(other_filename, 'r') as other_file:
-                    other_texts.extend(other_file.read().splitlines())
-            other_lines = [TextLineType(id="line%04d"%i,
-                                        TextEquiv=[TextEquivType(Unicode=line)])
-                           for i, line in enumerate(other_texts)]
+                if fast:
+                    other_regions = [(region.get('id'), xml_element_unicode0(region))
+                                     for region in xml_get_all_regions(other_page, classes=['Text'])]
+                else:
+                    other_regions = [(region.id, page_element_unicode0(region))
+                                     for region in other_page.get_AllRegions(classes=['Text'])]
+                for region_id, region_text in other_regions:
+                    region_texts = region_text.split('\r\n')
+                    other_texts.extend(region_texts)
+                    other_blocks.extend([region_id] * len(region_texts))
+                # create pseudo-lines
+                other_ids = ["line%04d" % i for i in range(len(other_texts))]
         if not len(other_texts):
             self.logger.error("no text lines on page %s of 2nd input", page_id)
             return
         skip = []
         for i, other_text in enumerate(other_texts):
             if not other_text.strip():
-                self.logger.warning("skipping empty line %s on page %s", other_lines[i].id, page_id)
+                self.logger.warning("skipping empty line %s on page %s", other_ids[i], page_id)
                 skip.append(i)
         for i in sorted(skip, reverse=True):
-            del other_lines[i]
+            del other_ids[i]
             del other_texts[i]
+            del other_blocks[i]
         # calculate assignments and scores
-        res, dst = align.match(texts, other_texts, workers=1,
-                               normalization=self.parameter['normalization'],
-                               try_subseg=self.parameter['allow_splits'])
+        if self.parameter['allow_splits'] and self.parallel is None:
+            self.parallel = self.parallel_stack.enter_context(joblib.Parallel(n_jobs=self.workers))
+        kwargs = dict(workers=self.workers,
+                      normalization=self.parameter['normalization'],
+                      try_subseg=self.parameter['allow_splits'],
+                      band=self.parameter['band'] or None,
+                      method=self.parameter['method'],
+                      cache_dir=self.parameter['cache_dir'] or None,
+                      parallel=self.parallel)
+        if self.parameter['hierarchical']:
+            res, dst = align.match_blocks(texts, other_texts, blocks, other_blocks, **kwargs)
+        else:
+            res, dst = align.match(texts, other_texts, **kwargs)
         if self.parameter['allow_splits']:
             res_ind, res_beg, res_end = res
         else:
             res_ind = res
-        for other_ind in set(range(len(other_texts))).difference(res_ind):
-            self.logger.warning("no match for %s on page %s", other_lines[other_ind].id, page_id)
+        unmatched = set(range(len(other_texts))).difference(res_ind)
+        if self.parameter['book_text']:
+            matched = [other_ind for other_ind in res_ind if other_ind >= 0]
+            if matched:
+                # continue with the next page after the last match
+                self.book_ends[page_id] = book_lines[other_ids[max(matched)]] + 1
+            # lines at the margins of the window belong to other pages
+            unmatched = {other_ind for other_ind in unmatched
+                         if matched and min(matched) < other_ind < max(matched)}
+        for other_ind in sorted(unmatched):
+            self.logger.warning("no match for %s on page %s", other_ids[other_ind], page_id)
         page_confs = []
         page_match = 0
         page_total = 0
         for ind, other_ind in enumerate(res_ind):
             line = lines[ind]
-            for n, textequiv in enumerate(line.TextEquiv or [], 1):
-                textequiv.index = n # increment @index of existing TextEquivs
-            if len(other_lines):
-                other_line = other_lines[other_ind]
+            # increment @index of existing TextEquivs
+            if fast:
+                for n, textequiv in enumerate(line.iterfind('pc:TextEquiv', NS), 1):
+                    textequiv.set('index', str(n))
             else:
-                # no textline level in 2nd input, only region level newline-split:
-                # create pseudo-line
-                other_text = other_texts[other_ind]
-                other_line = TextLineType(id="line%04d" % other_ind,
-                                          TextEquiv=[TextEquivType(Unicode=other_text)])
+                for n, textequiv in enumerate(line.TextEquiv or [], 1):
+                    textequiv.index = n
             page_total += 1
             if other_ind < 0:
-                self.logger.warning("unmatched line %s on page %s", line.id, page_id)
+                self.logger.warning("unmatched line %s on page %s", line_ids[ind], page_id)
                 continue
             page_match += 1
+            other_id = other_ids[other_ind]
+            other_text = other_texts[other_ind]
+            if self.parameter['allow_splits'] and res_beg[ind] >= 0 and res_end[ind] >= 0:
+                other_id += "[%d:%d]" % (res_beg[ind], res_end[ind])
+                other_text = other_text[res_beg[ind]:res_end[ind]]
             textequiv = TextEquivType()
             textequiv.index = 0
             textequiv.conf = dst[ind]
-            textequiv.Unicode = page_element_unicode0(other_line)
-            if self.parameter['allow_splits'] and res_beg[ind] >= 0 and res_end[ind] >= 0:
-                other_line.id += "[%d:%d]" % (res_beg[ind], res_end[ind])
-                textequiv.Unicode = textequiv.Unicode[res_beg[ind]:res_end[ind]]
+            textequiv.Unicode = other_text
             textequiv.dataType = 'other'
-            textequiv.dataTypeDetails = other_file_grp + '/' + other_line.id
-            self.logger.debug("matching line %s vs %s [%d%%]", line.id, other_line.id, 100 * dst[ind])
-            line.insert_TextEquiv_at(0, textequiv) # update
+            textequiv.dataTypeDetails = other_file_grp + '/' + other_id
+            self.logger.debug("matching line %s vs %s [%d%%]", line_ids[ind], other_id, 100 * dst[ind])
+            if fast:
+                xml_element_insert_textequiv0(line, textequiv)
+            else:
+                line.insert_TextEquiv_at(0, textequiv) # update
             page_confs.append(dst[ind])
         if len(page_confs):
             self.logger.info("average alignment accuracy for page %s: %d%%", page_id, 100 * sum(page_confs) / len(page_confs))
         if page_total:
             self.logger.info("coverage of matching lines for page %s: %d%%", page_id, 100 * page_match / page_total)
+        page_stats = AlignmentStats.page(page_id, page_confs, page_total,
+                                         len(other_texts), time.perf_counter() - page_start)
+        if self.stats_queue:
+            self.stats_queue.put(page_stats)
+        else:
+            self.stats.add(page_stats)
 
-        self.stats['all_confs'].extend(page_confs)
-        self.stats['all_match'] += page_match
-        self.stats['all_total'] += page_total
-
-        page_update_higher_textequiv_levels('line', pcgts)
-        page_remove_lower_textequiv_levels('line', pcgts)
-        # or metadata from other_pcgts (GT)?
-        pcgts.set_pcGtsId(output_file_id)
-        self.add_metadata(pcgts)
+        if fast:
+            xml_update_region_textequivs(page)
+            xml_remove_lower_textequiv_levels('line', page)
+            pcgts.getroot().set('pcGtsId', output_file_id)
+            self.add_metadata_xml(pcgts)
+        else:
+            page_update_higher_textequiv_levels('line', pcgts)
+            page_remove_lower_textequiv_levels('line', pcgts)
+            # or metadata from other_pcgts (GT)?
+            pcgts.set_pcGtsId(output_file_id)
+            self.add_metadata(pcgts)
+        output_filename = os.path.join(self.output_file_grp, output_file_id + '.xml')
+        # register in METS here (only the file itself gets written behind)
         self.workspace.add_file(
             file_id=output_file_id,
             file_grp=self.output_file_grp,
             page_id=page_id,
-            local_filename=os.path.join(self.output_file_grp, output_file_id + '.xml'),
+            local_filename=output_filename,
             mimetype=MIMETYPE_PAGE,
-            content=to_xml(pcgts),
         )
+        output_filename = os.path.join(self.workspace.directory, output_filename)
+        if self.writer:
+            self.writer.put(page_id, pcgts, output_filename)
+        else:
+            self.write_page_file(page_id, pcgts, output_filename)
+
+    def read_page_files(self, *input_files : Optional[OcrdFileType]) -> List[Optional[Union[OcrdPage,ET._ElementTree,tuple,str]]]:
+        """Parse (or read) the input files of a single page.
+
+        Returns a list with each PAGE file as
+        :py:class:`~ocrd_models.OcrdPage` (or, if ``fast_xml``,
+        as lxml element tree) and each plain text file as pair of
+        file name and content (or, if ``book_text``, just the file name),
+        or None where the file could not be parsed.
+        """
+        input_tuple : List[Optional[Union[OcrdPage,ET._ElementTree,tuple,str]]] = [None] * len(input_files)
+        page_id = input_files[0].pageId
+        for i, input_file in enumerate(input_files):
+            assert isinstance(input_file, get_args(OcrdFileType))
+            try:
+                if input_file.mimetype == MIMETYPE_PAGE:
+                    self._base_logger.debug(f"parsing file {input_file.ID} for page {page_id}")
+                    if self.parameter['fast_xml']:
+                        # only the element tree, without the PAGE object model
+                        input_tuple[i] = ET.parse(input_file.local_filename)
+                    else:
+                        page_ = page_from_file(input_file)
+                        assert isinstance(page_, OcrdPage)
+                        input_tuple[i] = page_
+                elif self.parameter['book_text']:
+                    # gets indexed once and then read on demand
+                    input_tuple[i] = input_file.local_filename
+                else:
+                    self._base_logger.debug(f"reading file {input_file.ID} for page {page_id}")
+                    with open(input_file.local_filename, 'r') as other_file:
+                        input_tuple[i] = (input_file.local_filename, other_file.read())
+            except ValueError as err:
+                # not PAGE and not an image to generate PAGE for
+                self._base_logger.error(f"non-PAGE input for page {page_id}: {err}")
+        return input_tuple
+
+    def write_page_file(self, page_id, pcgts, output_filename):
+        """Serialize the resulting PAGE hierarchy (or, if ``fast_xml``,
+        the lxml element tree) of a single page and write it to ``output_filename``.
+        """
+        self._base_logger.debug(f"writing file {output_filename} for page {page_id}")
+        if self.parameter['fast_xml']:
+            ET.indent(pcgts, space='    ')
+            content = ET.tostring(pcgts, xml_declaration=True, encoding='UTF-8')
+        else:
+            content = to_xml(pcgts).encode('utf-8')
+        with open(output_filename, 'wb') as output_file:
+            output_file.write(content)
+
+    def find_book_window(self, page_id, filename, texts):
+        """Find the lines of the document-level plain text file which match the given page.
+
+        Search for the window of lines corresponding to ``texts`` (see
+        :py:func:`~nmalign.lib.align.find_window`) right after where the
+        previous physical page ended (if that was already processed here,
+        or at the start of the text for the first page of the document),
+        or else around the position of the page relative to the whole
+        document. If nothing can be found there, then search the whole text.
+        Either way, the window never begins before the end of the previous page.
+
+        Returns the index of the first line and the lines of the window.
+        """
+        if not hasattr(self, 'books'):
+            self.books = {}
+        if filename not in self.books:
+            self.logger.debug("indexing lines of %s", filename)
+            self.books[filename] = BookText(filename)
+        book = self.books[filename]
+        kwargs = dict(normalization=self.parameter['normalization'], workers=self.workers)
+        rank = self.book_ranks[page_id]
+        if rank:
+            # only if the previous page was selected and processed already
+            previous = self.book_ends.get(self.book_pages[rank - 1])
+        else:
+            previous = 0
+        if previous is not None:
+            # lines before belong to the previous page
+            begin = previous
+            end = previous + 2 * len(texts)
+        else:
+            page_lines = len(book) // len(self.book_ranks)
+            center = page_lines * self.book_ranks[page_id]
+            begin = center - 2 * page_lines - len(texts)
+            end = center + 3 * page_lines + len(texts)
+        window = align.find_window(texts, book, begin, end, **kwargs)
+        if window is None:
+            self.logger.warning("no matching lines for page %s in lines %d-%d of %s, searching whole text",
+                                page_id, max(0, begin), min(len(book), end), filename)
+            window = align.find_window(texts, book, **kwargs)
+        if window is None:
+            return 0, []
+        begin, end = window
+        if previous and previous < end:
+            # (do not let the margins reach back into the previous page)
+            begin = max(begin, previous)
+        self.logger.debug("matching page %s with lines %d-%d of %s", page_id, begin, end, filename)
+        return begin, book[begin:end]
+
+    def add_metadata_xml(self, pcgts):
+        """Add PAGE-XML ``MetadataItem`` describing the processing step
+        (like :py:meth:`add_metadata`) to lxml element tree ``pcgts``.
+        """
+        metadata = MetadataType()
+        self.add_metadata(PcGtsType(Metadata=metadata))
+        # (the parameter values are not necessarily strings, so export as XML)
+        sio = StringIO()
+        metadata.get_MetadataItem()[0].export(
+            sio, 0, name_='MetadataItem', namespaceprefix_='pc:',
+            namespacedef_='xmlns:pc="%s"' % NS['pc'])
+        pcgts.find('pc:Metadata', NS).append(ET.fromstring(sio.getvalue()))
+
+class BookText:
+    """Lines of a (large) plain text file, read on demand.
+
+    Memory-maps the file, and indexes the offsets of all lines once.
+    Lines can then be retrieved by index or slice (like a list of strings,
+    but only decoding those lines).
+    """
+    def __init__(self, filename):
+        self.mmap = b''
+        if os.path.getsize(filename):
+            with open(filename, 'rb') as file:
+                self.mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        newlines = np.flatnonzero(np.frombuffer(self.mmap, dtype=np.uint8) == ord('\n'))
+        self.begins = np.concatenate([[0], newlines + 1])
+        self.ends = np.concatenate([newlines, [len(self.mmap)]])
+        if self.begins[-1] == len(self.mmap):
+            # no line after final newline
+            self.begins = self.begins[:-1]
+            self.ends = self.ends[:-1]
+
+    def __len__(self):
+        return len(self.begins)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        line = self.mmap[self.begins[index]:self.ends[index]]
+        return line.decode('utf-8').rstrip('\r')
+
+class PageReader:
+    """Background thread parsing the input files of the next pages.
+
+    Calls ``read`` on each of ``input_file_tuples`` in turn, queueing
+    the results for up to ``size`` pages ahead (blocking when full).
+    """
+    def __init__(self, read, input_file_tuples, size):
+        self.queue = queue.Queue(maxsize=size)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, args=(read, input_file_tuples), daemon=True)
+        self.thread.start()
+
+    def run(self, read, input_file_tuples):
+        for input_files in input_file_tuples + [None]:
+            if input_files is None:
+                result = None
+            else:
+                try:
+                    result = (input_files[0].pageId, read(*input_files), None)
+                except Exception as err:
+                    result = (input_files[0].pageId, None, err)
+            while True:
+                if self.stopped.is_set():
+                    return
+                try:
+                    self.queue.put(result, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+
+    def get(self, page_id):
+        """Get the parsed input files of ``page_id`` (or re-raise the error on reading them).
+
+        Skips results of previous pages not taken (because they failed early).
+        """
+        for result_page_id, result, error in iter(self.queue.get, None):
+            if result_page_id != page_id:
+                continue
+            if error:
+                raise error
+            return result
+        raise ValueError(f"no input files read for page {page_id}")
+
+    def stop(self):
+        """Stop reading ahead."""
+        self.stopped.set()
+        self.thread.join()
+
+class PageWriter:
+    """Background thread serializing and writing the output files of the previous pages.
+
+    Calls ``write`` for each page put into the queue (blocking while it
+    has ``size`` pages waiting). Errors get logged, and the first of them
+    is re-raised when closing.
+    """
+    def __init__(self, write, size, logger):
+        self.queue = queue.Queue(maxsize=size)
+        self.logger = logger
+        self.error = None
+        self.thread = threading.Thread(target=self.run, args=(write,))
+        self.thread.start()
+
+    def run(self, write):
+        for page_id, *args in iter(self.queue.get, None):
+            try:
+                write(page_id, *args)
+            except Exception as err:
+                self.logger.exception("failed writing output for page %s", page_id)
+                self.error = self.error or err
+
+    def put(self, *args):
+        """Queue page for writing."""
+        self.queue.put(args)
+
+    def close(self):
+        """Wait until all pages have been written."""
+        self.queue.put(None)
+        self.thread.join()
+        if self.error:
+            raise self.error
+
+class AlignmentStats:
+    """Alignment statistics of a workspace, merged from those of its pages.
+
+    Pages are processed independently (possibly in parallel), and their
+    figures aggregated locally into a single :py:meth:`page` record,
+    which can then be merged by :py:meth:`add` in any order.
+    """
+    BINS = 10 # histogram of scores over [0,1]
+
+    def __init__(self):
+        self.pages = {}
+        self.lines = 0
+        self.other_lines = 0
+        self.matched = 0
+        self.confs = 0.0
+        self.histogram = np.zeros(self.BINS, dtype=int)
+        self.seconds = 0.0
+
+    @classmethod
+    def page(cls, page_id, confs, lines, other_lines, seconds):
+        """Get statistics record for a single page."""
+        histogram, _ = np.histogram(confs, bins=cls.BINS, range=(0, 1))
+        return dict(page_id=page_id,
+                    lines=lines,
+                    other_lines=other_lines,
+                    matched=len(confs),
+                    confs=float(sum(confs)),
+                    histogram=histogram.tolist(),
+                    seconds=seconds)
+
+    def add(self, page):
+        """Merge statistics record of a single page."""
+        self.pages[page['page_id']] = page
+        self.lines += page['lines']
+        self.other_lines += page['other_lines']
+        self.matched += page['matched']
+        self.confs += page['confs']
+        self.histogram += page['histogram']
+        self.seconds += page['seconds']
+
+    def listen(self, queue):
+        """Merge page records from queue until receiving None."""
+        for page in iter(queue.get, None):
+            self.add(page)
+
+    def to_json(self):
+        """Get totals and per-page figures as JSON-serializable dict."""
+        def figures(stats):
+            return dict(lines=stats['lines'],
+                        other_lines=stats['other_lines'],
+                        matched=stats['matched'],
+                        coverage=stats['matched'] / stats['lines'] if stats['lines'] else 0,
+                        accuracy=stats['confs'] / stats['matched'] if stats['matched'] else 0,
+                        histogram=list(stats['histogram']),
+                        seconds=stats['seconds'])
+        total = figures(dict(lines=self.lines,
+                             other_lines=self.other_lines,
+                             matched=self.matched,
+                             confs=self.confs,
+                             histogram=self.histogram.tolist(),
+                             seconds=self.seconds))
+        total['pages'] = len(self.pages)
+        return dict(total=total,
+                    pages={page_id: figures(page)
+                           for page_id, page in self.pages.items()})
 
 # from ocrd_tesserocr
 def page_element_unicode0(element):
@@ -303,24 +808,35 @@ def page_element_conf0(element):
         return 1.0 if element.TextEquiv[0].conf is None else element.TextEquiv[0].conf
     return 1.0
 
+def page_get_line_regions(page, lines):
+    """Get the ID of the parent (text) region of each of the given lines on page."""
+    parents = {line.id: region.id
+               for region in page.get_AllRegions(classes=['Text'])
+               for line in region.get_TextLine()}
+    return [parents.get(line.id) for line in lines]
+
 def page_get_reading_order(ro, rogroup):
-    """Add all elements from the given reading order group to the given dictionary.
+    """Add all ordered elements from the given reading order group to the given dictionary.
     
-    Given a dict ``ro`` from layout element IDs to ReadingOrder element objects,
+    Given a dict ``ro`` from layout element IDs to their position in the ReadingOrder,
     and an object ``rogroup`` with additional ReadingOrder element objects,
-    add all references to the dict, traversing the group recursively.
+    add all references which are members of an ordered group to the dict
+    (at the next position), traversing the group recursively in order.
     """
-    regionrefs = list()
     if isinstance(rogroup, (OrderedGroupType, OrderedGroupIndexedType)):
-        regionrefs = (rogroup.get_RegionRefIndexed() +
-                      rogroup.get_OrderedGroupIndexed() +
-                      rogroup.get_UnorderedGroupIndexed())
-    if isinstance(rogroup, (UnorderedGroupType, UnorderedGroupIndexedType)):
+        ordered = True
+        regionrefs = sorted(rogroup.get_RegionRefIndexed() +
+                            rogroup.get_OrderedGroupIndexed() +
+                            rogroup.get_UnorderedGroupIndexed(),
+                            key=lambda elem: elem.index)
+    else:
+        ordered = False
         regionrefs = (rogroup.get_RegionRef() +
                       rogroup.get_OrderedGroup() +
                       rogroup.get_UnorderedGroup())
     for elem in regionrefs:
-        ro[elem.get_regionRef()] = elem
+        if ordered and elem.get_regionRef():
+            ro.setdefault(elem.get_regionRef(), len(ro))
         if not isinstance(elem, (RegionRefType, RegionRefIndexedType)):
             page_get_reading_order(ro, elem)
 
@@ -343,100 +859,130 @@ def page_update_higher_textequiv_levels(level, pcgts, overwrite=True):
     (if they appear there as an ``OrderedGroup``).
     Where no direction/order can be found, use XML ordering.
     
-    Follow regions recursively, but make sure to traverse them in a depth-first strategy.
+    Follow regions recursively, but make sure to traverse them in a depth-first strategy,
+    so each region gets updated only after all its subregions (bottom-up, in a single pass).
     """
+    if level == 'region':
+        return
     page = pcgts.get_Page()
     relations = page.get_Relations() # get RelationsType
     if relations:
         relations = relations.get_Relation() # get list of RelationType
     else:
         relations = []
-    joins = list() # 
+    joins = set()
     for relation in relations:
         if relation.get_type() == 'join': # ignore 'link' type here
-            joins.append((relation.get_SourceRegionRef().get_regionRef(),
-                          relation.get_TargetRegionRef().get_regionRef()))
+            joins.add((relation.get_SourceRegionRef().get_regionRef(),
+                       relation.get_TargetRegionRef().get_regionRef()))
     reading_order = dict()
     ro = page.get_ReadingOrder()
     if ro:
         page_get_reading_order(reading_order, ro.get_OrderedGroup() or ro.get_UnorderedGroup())
-    if level != 'region':
-        for region in page.get_AllRegions(classes=['Text']):
-            # order is important here, because regions can be recursive,
-            # and we want to concatenate by depth first;
-            # typical recursion structures would be:
-            #  - TextRegion/@type=paragraph inside TextRegion
-            #  - TextRegion/@type=drop-capital followed by TextRegion/@type=paragraph inside TextRegion
-            #  - any region (including TableRegion or TextRegion) inside a TextRegion/@type=footnote
-            #  - TextRegion inside TableRegion
-            subregions = region.get_TextRegion()
-            if subregions: # already visited in earlier iterations
-                # do we have a reading order for these?
-                # TODO: what if at least some of the subregions are in reading_order?
-                if (all(subregion.id in reading_order for subregion in subregions) and
-                    isinstance(reading_order[subregions[0].id], # all have .index?
-                               (OrderedGroupType, OrderedGroupIndexedType))):
-                    subregions = sorted(subregions, key=lambda subregion:
-                                        reading_order[subregion.id].index)
-                region_unicode = page_element_unicode0(subregions[0])
-                for subregion, next_subregion in zip(subregions, subregions[1:]):
-                    if (subregion.id, next_subregion.id) not in joins:
-                        region_unicode += '\n' # or '\f'?
-                    region_unicode += page_element_unicode0(next_subregion)
-                region_conf = sum(page_element_conf0(subregion) for subregion in subregions)
-                region_conf /= len(subregions)
-            else: # TODO: what if a TextRegion has both TextLine and TextRegion children?
-                lines = region.get_TextLine()
-                if ((region.get_textLineOrder() or
-                     page.get_textLineOrder()) ==
-                    TextLineOrderSimpleType.BOTTOMTOTOP):
-                    lines = list(reversed(lines))
-                if level != 'line':
-                    for line in lines:
-                        words = line.get_Word()
-                        if ((line.get_readingDirection() or
-                             region.get_readingDirection() or
-                             page.get_readingDirection()) ==
-                            ReadingDirectionSimpleType.RIGHTTOLEFT):
-                            words = list(reversed(words))
-                        if level != 'word':
-                            for word in words:
-                                glyphs = word.get_Glyph()
-                                if ((word.get_readingDirection() or
-                                     line.get_readingDirection() or
-                                     region.get_readingDirection() or
-                                     page.get_readingDirection()) ==
-                                    ReadingDirectionSimpleType.RIGHTTOLEFT):
-                                    glyphs = list(reversed(glyphs))
-                                word_unicode = ''.join(page_element_unicode0(glyph) for glyph in glyphs)
-                                word_conf = sum(page_element_conf0(glyph) for glyph in glyphs)
-                                if glyphs:
-                                    word_conf /= len(glyphs)
-                                if not word.get_TextEquiv() or overwrite:
-                                    word.set_TextEquiv( # replace old, if any
-                                        [TextEquivType(Unicode=word_unicode, conf=word_conf)])
-                        line_unicode = ' '.join(page_element_unicode0(word) for word in words)
-                        line_conf = sum(page_element_conf0(word) for word in words)
-                        if words:
-                            line_conf /= len(words)
-                        if not line.get_TextEquiv() or overwrite:
-                            line.set_TextEquiv( # replace old, if any
-                                [TextEquivType(Unicode=line_unicode, conf=line_conf)])
-                region_unicode = ''
-                region_conf = 0
-                if lines:
-                    region_unicode = page_element_unicode0(lines[0])
-                    for line, next_line in zip(lines, lines[1:]):
-                        words = line.get_Word()
-                        next_words = next_line.get_Word()
-                        if not(words and next_words and (words[-1].id, next_words[0].id) in joins):
-                            region_unicode += '\n'
-                        region_unicode += page_element_unicode0(next_line)
-                    region_conf = sum(page_element_conf0(line) for line in lines)
-                    region_conf /= len(lines)
-            if not region.get_TextEquiv() or overwrite:
-                region.set_TextEquiv( # replace old, if any
-                    [TextEquivType(Unicode=region_unicode, conf=region_conf)])
+
+    def get_textequiv0(element):
+        textequivs = element.get_TextEquiv()
+        if not textequivs:
+            return '', 1.0
+        return (textequivs[0].Unicode or '',
+                1.0 if textequivs[0].conf is None else textequivs[0].conf)
+
+    def set_textequiv(element, unicode, conf):
+        if element.get_TextEquiv() and not overwrite:
+            return get_textequiv0(element)
+        element.set_TextEquiv( # replace old, if any
+            [TextEquivType(Unicode=unicode, conf=conf)])
+        return unicode, conf
+
+    def update_line(line, region):
+        if level == 'line':
+            return get_textequiv0(line)
+        words = line.get_Word()
+        direction = (line.get_readingDirection() or
+                     region.get_readingDirection() or
+                     page.get_readingDirection())
+        if direction == ReadingDirectionSimpleType.RIGHTTOLEFT:
+            words = list(reversed(words))
+        if level == 'word':
+            return set_textequiv(line, *concat_textequivs(map(get_textequiv0, words), ' '))
+        word_textequivs = []
+        for word in words:
+            glyphs = word.get_Glyph()
+            if ((word.get_readingDirection() or direction) ==
+                ReadingDirectionSimpleType.RIGHTTOLEFT):
+                glyphs = list(reversed(glyphs))
+            word_textequivs.append(set_textequiv(
+                word, *concat_textequivs(map(get_textequiv0, glyphs), '')))
+        return set_textequiv(line, *concat_textequivs(word_textequivs, ' '))
+
+    def update_region(region):
+        # order is important here, because regions can be recursive,
+        # and we want to concatenate by depth first;
+        # typical recursion structures would be:
+        #  - TextRegion/@type=paragraph inside TextRegion
+        #  - TextRegion/@type=drop-capital followed by TextRegion/@type=paragraph inside TextRegion
+        #  - any region (including TableRegion or TextRegion) inside a TextRegion/@type=footnote
+        #  - TextRegion inside TableRegion
+        subregion_textequivs = {subregion.id: update_region(subregion)
+                                for subregion in page_get_subregions(region)}
+        if not isinstance(region, TextRegionType):
+            return None
+        subregions = region.get_TextRegion()
+        if subregions:
+            # do we have a reading order for these?
+            # TODO: what if at least some of the subregions are in reading_order?
+            if all(subregion.id in reading_order for subregion in subregions):
+                subregions = sorted(subregions, key=lambda subregion:
+                                    reading_order[subregion.id])
+            joined = [(subregion.id, next_subregion.id) in joins
+                      for subregion, next_subregion in zip(subregions, subregions[1:])]
+            return set_textequiv(region, *concat_textequivs(
+                [subregion_textequivs[subregion.id] for subregion in subregions],
+                '\n', joined)) # or '\f'?
+        # TODO: what if a TextRegion has both TextLine and TextRegion children?
+        lines = region.get_TextLine()
+        if ((region.get_textLineOrder() or
+             page.get_textLineOrder()) ==
+            TextLineOrderSimpleType.BOTTOMTOTOP):
+            lines = list(reversed(lines))
+        # (look up joins before lower levels get replaced)
+        words = [line.get_Word() for line in lines]
+        joined = [bool(line_words and next_words) and
+                  (line_words[-1].id, next_words[0].id) in joins
+                  for line_words, next_words in zip(words, words[1:])]
+        line_textequivs = [update_line(line, region) for line in lines]
+        return set_textequiv(region, *concat_textequivs(line_textequivs, '\n', joined))
+
+    for region in page_get_subregions(page):
+        update_region(region)
+
+def page_get_subregions(element):
+    """Get all regions directly contained in the given page or region (grouped by class)."""
+    return [subregion
+            for class_ in PAGE_REGION_TYPES
+            # 'Map' is not recursive in 2019 schema
+            if class_ != 'Map' or isinstance(element, PageType)
+            for subregion in getattr(element, 'get_%sRegion' % class_)()]
+
+def concat_textequivs(textequivs, sep, joined=None):
+    """Concatenate pairs of Unicode and conf from a sequence of elements.
+
+    Join the strings by ``sep`` (except between successive elements
+    where ``joined`` is true), and average the confidences.
+    Return the resulting pair (or an empty string with zero
+    confidence if there are no elements).
+    """
+    textequivs = list(textequivs)
+    if not textequivs:
+        return '', 0
+    if joined is None:
+        joined = [False] * (len(textequivs) - 1)
+    parts = [textequivs[0][0]]
+    for (unicode, _), join in zip(textequivs[1:], joined):
+        if not join:
+            parts.append(sep)
+        parts.append(unicode)
+    return ''.join(parts), sum(conf for _, conf in textequivs) / len(textequivs)
 
 def page_remove_lower_textequiv_levels(level, pcgts):
     page = pcgts.Page
@@ -455,6 +1001,174 @@ def page_remove_lower_textequiv_levels(level, pcgts):
                         for glyph in word.Glyph:
                             glyph.Graphemes = []
 
+def xml_element_unicode0(element):
+    """Get Unicode string of the first text result of lxml element."""
+    textequiv = element.find('pc:TextEquiv', NS)
+    if textequiv is None:
+        return ''
+    return textequiv.findtext('pc:Unicode', '', NS)
+
+def xml_element_conf0(element):
+    """Get confidence (as float value) of the first text result of lxml element."""
+    textequiv = element.find('pc:TextEquiv', NS)
+    if textequiv is None:
+        return 1.0
+    return float(textequiv.get('conf', 1.0))
+
+# elements which must follow TextEquiv in PAGE-XML (by parent element)
+XML_AFTER_TEXTEQUIV = {
+    'TextLine': ['TextStyle', 'UserDefined', 'Labels'],
+    'TextRegion': ['TextStyle'],
+}
+
+def xml_element_insert_textequiv0(element, textequiv):
+    """Insert TextEquivType ``textequiv`` as first text result of lxml element."""
+    pos = len(element)
+    following = ['{%s}%s' % (NS['pc'], name)
+                 for name in ['TextEquiv'] + XML_AFTER_TEXTEQUIV[ET.QName(element).localname]]
+    for i, child in enumerate(element):
+        if child.tag in following:
+            pos = i
+            break
+    element.insert(pos, textequiv.to_etree(name_='TextEquiv'))
+
+def xml_element_set_textequiv(element, textequiv):
+    """Replace all text results of lxml element by TextEquivType ``textequiv``."""
+    for old in element.findall('pc:TextEquiv', NS):
+        element.remove(old)
+    xml_element_insert_textequiv0(element, textequiv)
+
+def xml_get_page(pcgts):
+    """Get the Page element of lxml element tree ``pcgts``.
+
+    Raises ValueError if the tree is not in the PAGE namespace of :py:data:`NS`
+    (other versions of the schema are only supported by the PAGE object model).
+    """
+    root = pcgts.getroot()
+    if root.tag != '{%s}PcGts' % NS['pc']:
+        raise ValueError(f"unsupported PAGE namespace for fast_xml: {ET.QName(root).namespace} "
+                         f"(only {NS['pc']})")
+    return root.find('pc:Page', NS)
+
+def xml_get_subregions(element):
+    """Get all region elements directly contained in lxml page or region (grouped by class)."""
+    return [subregion
+            for class_ in PAGE_REGION_TYPES
+            # 'Map' is not recursive in 2019 schema
+            if class_ != 'Map' or ET.QName(element).localname == 'Page'
+            for subregion in element.iterchildren('{%s}%sRegion' % (NS['pc'], class_))]
+
+def xml_get_all_regions(element, classes=None):
+    """Get all (recursive) region elements of lxml element, or only those provided by ``classes``.
+
+    Traverse in the same order as :py:meth:`PageType.get_AllRegions`, i.e. depth-first
+    and within each level by region class, then by document order.
+    """
+    regions = []
+    for region in xml_get_subregions(element):
+        if not classes or ET.QName(region).localname[:-6] in classes:
+            regions.append(region)
+        regions.extend(xml_get_all_regions(region, classes=classes))
+    return regions
+
+def xml_get_all_textlines(page):
+    """Get all TextLine elements of lxml page (in the order of :py:meth:`PageType.get_AllTextLines`)."""
+    lines = []
+    for region in xml_get_all_regions(page, classes=['Text']):
+        region_lines = region.findall('pc:TextLine', NS)
+        order = region.get('textLineOrder') or page.get('textLineOrder') or 'top-to-bottom'
+        if order not in ['top-to-bottom', 'left-to-right']:
+            region_lines.reverse()
+        lines.extend(region_lines)
+    return lines
+
+def xml_get_reading_order(ro, rogroup):
+    """Like :py:func:`page_get_reading_order`, but for lxml group element."""
+    ordered = ET.QName(rogroup).localname.startswith('OrderedGroup')
+    regionrefs = [elem for elem in rogroup
+                  if isinstance(elem.tag, str) and
+                  ET.QName(elem).localname.startswith(('RegionRef', 'OrderedGroup', 'UnorderedGroup'))]
+    if ordered:
+        regionrefs.sort(key=lambda elem: int(elem.get('index')))
+    for elem in regionrefs:
+        if ordered and elem.get('regionRef'):
+            ro.setdefault(elem.get('regionRef'), len(ro))
+        if not ET.QName(elem).localname.startswith('RegionRef'):
+            xml_get_reading_order(ro, elem)
+
+def xml_update_region_textequivs(page, overwrite=True):
+    """Update the TextEquivs of all text regions of lxml page from their lines.
+
+    Equivalent to :py:func:`page_update_higher_textequiv_levels` for ``level='line'``,
+    but working on the element tree directly.
+    """
+    joins = set()
+    for relation in page.iterfind('pc:Relations/pc:Relation', NS):
+        if relation.get('type') == 'join': # ignore 'link' type here
+            joins.add((relation.find('pc:SourceRegionRef', NS).get('regionRef'),
+                       relation.find('pc:TargetRegionRef', NS).get('regionRef')))
+    reading_order = dict()
+    ro = page.find('pc:ReadingOrder/*', NS)
+    if ro is not None:
+        xml_get_reading_order(reading_order, ro)
+
+    def get_textequiv0(element):
+        textequiv = element.find('pc:TextEquiv', NS)
+        if textequiv is None:
+            return '', 1.0
+        return textequiv.findtext('pc:Unicode', '', NS), float(textequiv.get('conf', 1.0))
+
+    def update_region(region):
+        # depth-first, so subregions are complete before their parent
+        subregion_textequivs = {subregion.get('id'): update_region(subregion)
+                                for subregion in xml_get_subregions(region)}
+        if ET.QName(region).localname != 'TextRegion':
+            return None
+        subregions = region.findall('pc:TextRegion', NS)
+        if subregions:
+            # do we have a reading order for these?
+            if all(subregion.get('id') in reading_order for subregion in subregions):
+                subregions = sorted(subregions, key=lambda subregion:
+                                    reading_order[subregion.get('id')])
+            joined = [(subregion.get('id'), next_subregion.get('id')) in joins
+                      for subregion, next_subregion in zip(subregions, subregions[1:])]
+            unicode, conf = concat_textequivs(
+                [subregion_textequivs[subregion.get('id')] for subregion in subregions],
+                '\n', joined)
+        else:
+            lines = region.findall('pc:TextLine', NS)
+            if ((region.get('textLineOrder') or
+                 page.get('textLineOrder')) == 'bottom-to-top'):
+                lines.reverse()
+            joined = None
+            if joins:
+                words = [line.findall('pc:Word', NS) for line in lines]
+                joined = [bool(line_words and next_words) and
+                          (line_words[-1].get('id'), next_words[0].get('id')) in joins
+                          for line_words, next_words in zip(words, words[1:])]
+            unicode, conf = concat_textequivs(map(get_textequiv0, lines), '\n', joined)
+        if region.find('pc:TextEquiv', NS) is not None and not overwrite:
+            return get_textequiv0(region)
+        xml_element_set_textequiv( # replace old, if any
+            region, TextEquivType(Unicode=unicode, conf=conf))
+        return unicode, conf
+
+    for region in xml_get_subregions(page):
+        update_region(region)
+
+def xml_remove_lower_textequiv_levels(level, page):
+    """Like :py:func:`page_remove_lower_textequiv_levels`, but on lxml page."""
+    if level == 'region':
+        path = './/pc:TextRegion/pc:TextEquiv'
+    elif level == 'line':
+        path = './/pc:TextLine/pc:Word'
+    elif level == 'word':
+        path = './/pc:Word/pc:Glyph'
+    else:
+        path = './/pc:Glyph/pc:Graphemes'
+    for element in page.findall(path, NS):
+        element.getparent().remove(element)
+
 @click.command()
 @ocrd_cli_options
 def ocrd_nmalign_merge(*args, **kwargs):
@@ -1,6 +1,11 @@
+import sys
 import click
 import cloup
 import json
+try:
+    import resource
+except ImportError: # not on Windows
+    resource = None
 
 from . import OptionEatAll
 from ..lib import align
@@ -8,11 +13,35 @@ from ..lib import align
 CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
 
 @cloup.command(context_settings=CONTEXT_SETTINGS)
-@cloup.option('-i', '--interactive', is_flag=True, help='prompt for each assigned pair, either proceeding or skipping')
+@cloup.option('-i', '--interactive', is_flag=True, help='prompt for each assigned pair, either proceeding or skipping (greedy method only)')
 @cloup.option('-c', '--cutoff', default=0.0, help='minimum score', type=cloup.FloatRange(min=0.0, max=1.0))
+@cloup.option('-r', '--report-cutoffs', multiple=True, help='instead of a single cutoff, calculate results for each of these cutoffs at once (repeatable, dense mode only) and print them as JSON', type=cloup.FloatRange(min=0.0, max=1.0))
 @cloup.option('-j', '--processes', default=1, help='number of processes to run in parallel', type=cloup.IntRange(min=1, max=32))
 @cloup.option('-N', '--normalization', default=None, help='JSON object with regex patterns and replacements to be applied before comparison')
 @cloup.option('-x', '--allow-splits', is_flag=True, help='find multiple submatches if replacement scores low')
+@cloup.option('-e', '--exact-splits', is_flag=True, help='find submatches by exact local alignment (Smith-Waterman) instead of partial ratio (slower, but more precise)')
+@cloup.option('-a', '--method', default='greedy', help='how to find pairs: iteratively taking the next closest one (preferring local monotonicity), the assignment with maximum total score in one shot (faster, not interactive), or the in-order alignment with maximum total score (fastest, but only for inputs in the same order)', type=cloup.Choice(['greedy', 'optimal', 'monotone']))
+@cloup.constraint(
+    cloup.constraints.If(~cloup.constraints.Equal('method', 'greedy'),
+                         then=cloup.constraints.accept_none),
+    ['interactive'])
+@cloup.option('-m', '--low-memory', is_flag=True, help='score in single precision (less memory, but ties may resolve differently)')
+@cloup.option('-k', '--topk', default=None, help='only keep this many best candidates for each string of list 1 (sparse mode for large inputs; also restricts blocking or prefilter)', type=cloup.IntRange(min=1))
+@cloup.option('-b', '--blocking', default=None, help='only compare pairs sharing at least this fraction of character trigrams (faster for large inputs, lower values increase recall)', type=cloup.FloatRange(min=0.0, max=1.0, min_open=True))
+@cloup.option('-P', '--prefilter', is_flag=True, help='only compare pairs which can reach the cutoff by their character counts (and, with topk, have the most similar character bigrams; faster for large inputs; not with blocking)')
+@cloup.option('-B', '--band', default=None, help='only compare pairs up to this distance from the diagonal, widening where no good match is found (faster for large inputs in mostly the same order; not with topk, blocking or prefilter)', type=cloup.IntRange(min=1))
+@cloup.constraint(
+    cloup.constraints.If('band',
+                         then=cloup.constraints.accept_none),
+    ['topk', 'blocking', 'prefilter'])
+@cloup.constraint(cloup.constraints.mutually_exclusive, ['blocking', 'prefilter'])
+@cloup.option('-A', '--anchored', is_flag=True, help='first pair strings occurring exactly once on either side (ignoring whitespace and case) as anchors, then align only between consecutive anchors, in parallel (much faster for long inputs in mostly the same order)')
+@cloup.option('-M', '--max-memory', default=None, help='in sparse mode, compute scores in chunks of at most this size (in MiB)', type=cloup.IntRange(min=1))
+@cloup.constraint(
+    cloup.constraints.If('report_cutoffs',
+                         then=cloup.constraints.accept_none),
+    ['topk', 'blocking', 'prefilter', 'band', 'max_memory'])
+@cloup.option('-C', '--cache-dir', default=None, help='directory to store similarity matrices in for reuse in subsequent calls on the same input', type=cloup.Path(file_okay=False))
 @cloup.option('-s', '--show-strings', is_flag=True, help='print strings themselves instead of indices')
 @cloup.option('-f', '--show-files', is_flag=True, help='print file names themselves instead of indices')
 @cloup.constraint(cloup.constraints.mutually_exclusive, ['show_strings', 'show_files'])
@@ -38,7 +67,9 @@ CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
     cloup.constraints.If('show_files',
                          then=cloup.constraints.require_one),
     ['files2', 'filelist2'])
-def cli(interactive, cutoff, processes, normalization, allow_splits, show_strings, show_files, separator,
+def cli(interactive, cutoff, report_cutoffs, processes, normalization, allow_splits, exact_splits,
+        method, low_memory, topk, blocking, prefilter, band, anchored, max_memory, cache_dir,
+        show_strings, show_files, separator,
         strings1, files1, filelist1,
         strings2, files2, filelist2):
     """Force-align two lists of strings.
@@ -47,7 +78,9 @@ def cli(interactive, cutoff, processes, normalization, allow_splits, show_string
     (after optionally normalising both sides).
 
     Then iteratively searches the next closest pair, while trying
-    to maintain local monotonicity.
+    to maintain local monotonicity. (Alternatively, finds the pairs
+    with maximum total score in one shot, or - for inputs in the same
+    order - the in-order alignment with maximum total score.)
 
     If splits are allowed and the score is already low, then searches
     for more matches among l1 for the pair's right side sequence:
@@ -61,6 +94,12 @@ def cli(interactive, cutoff, processes, normalization, allow_splits, show_string
     Prints the corresponding list indices and match scores [0.0,1.0]
     as CSV data. (For subsequences, the start and end position will
     be appended.)
+
+    If multiple cutoffs are to be reported, calculates similarities
+    only once, and prints results along with statistics for each
+    cutoff as JSON.
+
+    Reports alignment statistics and peak memory usage to stderr.
     """
     #list1 = list(map(file_.read() for file_ in files1))
     if strings1:
@@ -80,50 +119,82 @@ def cli(interactive, cutoff, processes, normalization, allow_splits, show_string
     else:
         normalization = None
     # calculate assignments and scores
-    res, dst = align.match(list1, list2,
-                           normalization=normalization,
-                           workers=processes,
-                           try_subseg=allow_splits,
-                           cutoff=cutoff,
-                           interactive=interactive)
-    if allow_splits:
-        res_ind, res_beg, res_end = res
+    kwargs = dict(normalization=normalization,
+                  workers=processes,
+                  try_subseg=allow_splits,
+                  exact_subseg=exact_splits,
+                  method=method,
+                  interactive=interactive,
+                  lowmem=low_memory,
+                  topk=topk,
+                  blocking=blocking,
+                  prefilter=prefilter,
+                  band=band,
+                  max_memory=max_memory * 1024 ** 2 if max_memory else None,
+                  cache_dir=cache_dir)
+    if report_cutoffs and not anchored:
+        results = align.match_cutoffs(list1, list2, report_cutoffs, **kwargs)
     else:
-        res_ind = res
-    scores = []
-    match1 = set()
-    match2 = set()
-    for ind1, ind2 in enumerate(res_ind):
-        score = dst[ind1]
-        if ind2 >= 0:
-            scores.append(score)
-        if show_strings:
-            if ind2 < 0:
-                continue
-            a = list1[ind1]
-            b = list2[ind2]
+        match = align.match_anchored if anchored else align.match
+        results = [match(list1, list2, cutoff=cutoff, **kwargs)
+                   for cutoff in report_cutoffs or [cutoff]]
+    report = dict()
+    for cutoff, (res, dst) in zip(report_cutoffs or [cutoff], results):
+        if allow_splits:
+            res_ind, res_beg, res_end = res
+        else:
+            res_ind = res
+        pairs = []
+        scores = []
+        match1 = set()
+        match2 = set()
+        for ind1, ind2 in enumerate(res_ind):
+            score = dst[ind1]
+            if ind2 >= 0:
+                scores.append(score)
+            if show_strings:
+                if ind2 < 0:
+                    continue
+                a = list1[ind1]
+                b = list2[ind2]
+                if allow_splits and res_beg[ind1] >= 0 and res_end[ind1] >= 0:
+                    b = b[res_beg[ind1]:res_end[ind1]]
+            elif show_files:
+                if ind2 < 0:
+                    continue
+                a = files1[ind1]
+                b = files2[ind2]
+            else:
+                a = str(ind1)
+                b = str(ind2)
+            pair = [a, b, float(score)]
             if allow_splits and res_beg[ind1] >= 0 and res_end[ind1] >= 0:
-                b = b[res_beg[ind1]:res_end[ind1]]
-        elif show_files:
+                pair += [int(res_beg[ind1]), int(res_end[ind1])]
+            pairs.append(pair)
             if ind2 < 0:
                 continue
-            a = files1[ind1]
-            b = files2[ind2]
-        else:
-            a = str(ind1)
-            b = str(ind2)
-        msg = a + separator + b + separator + "%.2f" % score
-        if allow_splits and res_beg[ind1] >= 0 and res_end[ind1] >= 0:
-            msg += separator + str(res_beg[ind1]) + separator + str(res_end[ind1])
-        click.echo(msg)
-        if ind2 < 0:
-            continue
-        match1.add(ind1)
-        match2.add(ind2)
-    if len(scores):
-        click.echo("average alignment confidence: %d%%" % (100 * sum(scores) / len(scores)), err=True)
-    click.echo("coverage of matching inputs1: %d%%" % (100 * len(match1) / len(list1)), err=True)
-    click.echo("coverage of matching inputs2: %d%%" % (100 * len(match2) / len(list2)), err=True)
+            match1.add(ind1)
+            match2.add(ind2)
+        report["%g" % cutoff] = dict(
+            pairs=pairs,
+            confidence=float(sum(scores) / len(scores)) if len(scores) else None,
+            coverage1=len(match1) / len(list1),
+            coverage2=len(match2) / len(list2))
+    if report_cutoffs:
+        click.echo(json.dumps(report, indent=2, ensure_ascii=False))
+    else:
+        for pair in pairs:
+            click.echo(separator.join([pair[0], pair[1], "%.2f" % pair[2]] +
+                                      list(map(str, pair[3:]))))
+        if len(scores):
+            click.echo("average alignment confidence: %d%%" % (100 * sum(scores) / len(scores)), err=True)
+        click.echo("coverage of matching inputs1: %d%%" % (100 * len(match1) / len(list1)), err=True)
+        click.echo("coverage of matching inputs2: %d%%" % (100 * len(match2) / len(list2)), err=True)
+    if resource:
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform != 'darwin':
+            maxrss *= 1024 # in KiB
+        click.echo("peak memory usage: %d MiB" % (maxrss / 1024 ** 2), err=True)
 
 if __name__ == '__main__':
     cli()
@@ -0,0 +1,52 @@
+"""Benchmark of assignment methods for line alignment.
+
+Compares the iterative ``greedy`` search against the one-shot ``optimal``
+assignment and the ``monotone`` dynamic program on a synthetic page: noisy copies of random lines, with some
+neighbours swapped, some lines dropped and some inserted. Reports runtime
+and how many lines were assigned to their true counterpart.
+
+Run via ``python -m tests.benchmark_method [NUM_LINES [NUM_RUNS]]``.
+"""
+
+import sys
+import random
+import timeit
+
+from nmalign.lib.align import match
+
+from .benchmark_subseg import WORDS, noisy
+
+def main(num_lines=500, num_runs=3):
+    rnd = random.Random(0)
+    lines = [' '.join(rnd.choice(WORDS) for _ in range(rnd.randint(2, 10)))
+             for _ in range(num_lines)]
+    order = list(range(num_lines))
+    for i in range(0, num_lines - 1, 10):
+        # swap some neighbours
+        order[i], order[i + 1] = order[i + 1], order[i]
+    # drop some lines
+    order = [i for i in order if rnd.random() > 0.05]
+    l2 = [lines[i] for i in order]
+    # pairs of l1 string and index of true counterpart in l2
+    pairs = [(noisy(lines[i], 0.05, rnd), j) for j, i in enumerate(order)]
+    pairs.sort(key=lambda pair: order[pair[1]])
+    # insert some lines
+    for _ in range(num_lines // 20):
+        pairs.insert(rnd.randrange(len(pairs)),
+                     (' '.join(rnd.choice(WORDS) for _ in range(5)), -1))
+    l1, truth = zip(*pairs)
+    print("%d vs %d lines" % (len(l1), len(l2)))
+    for name, kwargs in [("greedy", dict(method='greedy')),
+                         ("optimal", dict(method='optimal')),
+                         ("greedy (topk=10)", dict(method='greedy', topk=10)),
+                         ("optimal (topk=10)", dict(method='optimal', topk=10)),
+                         ("monotone", dict(method='monotone')),
+                         ("monotone (band=10)", dict(method='monotone', band=10))]:
+        func = lambda: match(l1, l2, cutoff=0.5, **kwargs)
+        secs = min(timeit.repeat(func, number=1, repeat=num_runs))
+        res, _ = func()
+        correct = sum(ind2 == true2 for ind2, true2 in zip(res, truth))
+        print("%-20s %8.2f ms  %d/%d correct" % (name, 1000 * secs, correct, len(l1)))
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
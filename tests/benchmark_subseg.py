@@ -0,0 +1,67 @@
+"""Micro-benchmark of local aligners for subsegmentation.
+
+Compares ``partial_ratio_alignment`` (one call per candidate) against the
+batched ``smith_waterman`` on synthetic split lines, reporting runtime and
+how often the span of each line within the concatenation was found
+(exactly or approximately).
+
+Run via ``python -m tests.benchmark_subseg [NUM_LINES [NUM_RUNS]]``.
+"""
+
+import sys
+import random
+import timeit
+
+from rapidfuzz.fuzz import partial_ratio_alignment
+
+from nmalign.lib.align import smith_waterman
+
+WORDS = ("lorem ipsum dolor sit amet consetetur sadipscing elitr sed diam "
+         "nonumy eirmod tempor invidunt ut labore et dolore magna aliquyam "
+         "erat voluptua at vero eos accusam justo duo dolores ea rebum").split()
+
+def noisy(s, rate, rnd):
+    # random substitutions, deletions and insertions
+    out = []
+    for c in s:
+        r = rnd.random()
+        if r < rate:
+            out.append(rnd.choice('abcdefghij'))
+        elif r < 2 * rate:
+            pass
+        elif r < 3 * rate:
+            out.append(c + rnd.choice('abcdefghij'))
+        else:
+            out.append(c)
+    return ''.join(out)
+
+def main(num_lines=20, num_runs=5):
+    rnd = random.Random(0)
+    lines = [' '.join(rnd.choice(WORDS) for _ in range(rnd.randint(4, 12)))
+             for _ in range(num_lines)]
+    seg2 = ' '.join(lines)
+    spans = []
+    pos = 0
+    for line in lines:
+        spans.append((pos, pos + len(line)))
+        pos += len(line) + 1
+    seg1s = [noisy(line, 0.03, rnd) for line in lines]
+    def run_partial_ratio():
+        return [(res.dest_start, res.dest_end) for res in
+                (partial_ratio_alignment(seg1, seg2) for seg1 in seg1s)]
+    def run_smith_waterman():
+        _, starts, ends = smith_waterman(seg1s, seg2)
+        return list(zip(starts, ends))
+    print("%d lines, %d characters" % (num_lines, len(seg2)))
+    for name, func in [("partial_ratio_alignment", run_partial_ratio),
+                       ("smith_waterman", run_smith_waterman)]:
+        secs = min(timeit.repeat(func, number=1, repeat=num_runs))
+        found = func()
+        exact = sum(span == tuple(res) for span, res in zip(spans, found))
+        close = sum(abs(span[0] - res[0]) + abs(span[1] - res[1]) <= 2
+                    for span, res in zip(spans, found))
+        print("%-24s %8.2f ms  %d/%d exact spans, %d/%d within 2 chars" % (
+            name, 1000 * secs, exact, num_lines, close, num_lines))
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
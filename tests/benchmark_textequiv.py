@@ -0,0 +1,86 @@
+"""Benchmark of updating region text from lines in PAGE-XML.
+
+Builds a synthetic page with lines of words in nested text regions (with
+an ordered ``ReadingOrder`` for the subregions, and a ``join`` relation
+between every other pair of successive lines), then times
+``page_update_higher_textequiv_levels`` (on the PAGE object model, from
+the line and from the word level) and ``xml_update_region_textequivs``
+(on the element tree).
+
+Run via ``python -m tests.benchmark_textequiv [NUM_LINES [NUM_RUNS]]``.
+"""
+
+import sys
+import random
+import timeit
+
+from lxml import etree as ET
+from ocrd_models.ocrd_page import (
+    PcGtsType,
+    PageType,
+    TextRegionType,
+    TextLineType,
+    WordType,
+    TextEquivType,
+    CoordsType,
+    ReadingOrderType,
+    OrderedGroupType,
+    RegionRefIndexedType,
+    RelationsType,
+    RelationType,
+    RegionRefType,
+    to_xml,
+)
+
+from nmalign.ocrd.cli import (
+    NS,
+    page_update_higher_textequiv_levels,
+    xml_update_region_textequivs,
+)
+
+from .benchmark_subseg import WORDS
+
+def make_page(num_lines, lines_per_region=10, regions_per_parent=10, rnd=None):
+    rnd = rnd or random.Random(0)
+    coords = lambda: CoordsType(points='0,0 1,0 1,1 0,1')
+    lines = []
+    joins = []
+    for i in range(num_lines):
+        words = [WordType(id='l%d_w%d' % (i, j), Coords=coords(),
+                          TextEquiv=[TextEquivType(Unicode=rnd.choice(WORDS), conf=rnd.random())])
+                 for j in range(rnd.randint(2, 10))]
+        lines.append(TextLineType(id='l%d' % i, Coords=coords(), Word=words,
+                                  TextEquiv=[TextEquivType(Unicode=' '.join(
+                                      word.TextEquiv[0].Unicode for word in words))]))
+        if i % 2:
+            joins.append(RelationType(id='rel%d' % i, type_='join',
+                                      SourceRegionRef=RegionRefType(regionRef=lines[-2].Word[-1].id),
+                                      TargetRegionRef=RegionRefType(regionRef=words[0].id)))
+    paragraphs = [TextRegionType(id='r%d' % i, Coords=coords(),
+                                 TextLine=lines[i:i + lines_per_region])
+                  for i in range(0, num_lines, lines_per_region)]
+    regions = [TextRegionType(id='p%d' % i, Coords=coords(),
+                              TextRegion=paragraphs[i:i + regions_per_parent])
+               for i in range(0, len(paragraphs), regions_per_parent)]
+    order = list(range(len(paragraphs)))
+    rnd.shuffle(order)
+    ro = ReadingOrderType(OrderedGroup=OrderedGroupType(id='ro', RegionRefIndexed=[
+        RegionRefIndexedType(index=index, regionRef=paragraph.id)
+        for index, paragraph in zip(order, paragraphs)]))
+    page = PageType(imageFilename='page.png', imageWidth=1, imageHeight=1,
+                    ReadingOrder=ro, Relations=RelationsType(Relation=joins),
+                    TextRegion=regions)
+    return PcGtsType(pcGtsId='page', Page=page)
+
+def main(num_lines=2000, num_runs=3):
+    pcgts = make_page(num_lines)
+    page = ET.fromstring(to_xml(pcgts).encode('utf-8')).find('pc:Page', NS)
+    print("%d lines" % num_lines)
+    for name, func in [("line level", lambda: page_update_higher_textequiv_levels('line', pcgts)),
+                       ("word level", lambda: page_update_higher_textequiv_levels('word', pcgts)),
+                       ("line level (lxml)", lambda: xml_update_region_textequivs(page))]:
+        secs = min(timeit.repeat(func, number=1, repeat=num_runs))
+        print("%-20s %8.2f ms" % (name, 1000 * secs))
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
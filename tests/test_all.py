@@ -4,14 +4,30 @@ import os
 import json
 import logging
 import numpy as np
+import joblib
+from rapidfuzz.process import cdist
+from rapidfuzz.distance.Levenshtein import normalized_similarity
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import shortest_path
 import pytest
+from lxml import etree as ET
 
-from ocrd import run_processor
+from ocrd import Resolver, run_processor
 from ocrd_utils import MIMETYPE_PAGE, make_file_id, config
 from ocrd_models.constants import NAMESPACES as NS
 from ocrd_modelfactory import page_from_file
+from ocrd_models.ocrd_page import to_xml
 
-from nmalign.ocrd.cli import NMAlignMerge
+from nmalign.ocrd.cli import (
+    NMAlignMerge,
+    BookText,
+    page_update_higher_textequiv_levels,
+    xml_update_region_textequivs,
+    xml_get_page,
+)
+from nmalign.lib import align
+
+from .benchmark_textequiv import make_page
 
 NRM = {
     " *\\n": " ",
@@ -50,6 +66,16 @@ def test_ocrd(workspace, subtests, caplog):
             assert len(rstr) > 0, rline.getparent().get('id')
             if len(rstr) <= 4:
                 rlines_short.append((rline.getparent().get('id'), page))
+    def textequivs(result):
+        # all text results of lines and regions (and their attributes)
+        return [(ET.QName(textequiv.getparent()).localname,
+                 textequiv.getparent().get('id'),
+                 textequiv.get('index'),
+                 textequiv.get('dataType'),
+                 textequiv.get('dataTypeDetails'),
+                 textequiv.findtext('page:Unicode', namespaces=NS),
+                 float(textequiv.get('conf', 1.0)))
+                for textequiv in page_from_file(result).etree.iterfind('.//page:TextEquiv', NS)]
     grps = [grp for grp in ws.mets.file_groups
             if 'OCR-D-OCR-' in grp]
     for other_file_grp in grps:
@@ -69,7 +95,12 @@ def test_ocrd(workspace, subtests, caplog):
         #         assert len(istr) > 0, iline.getparent().get('id')
         input_file_grp = grp0 + ',' + other_file_grp
         output_file_grp = other_file_grp + '-SEG-GT'
-        for mode in ["pagexml", "plaintext"]:
+        mode_results = {}
+        for mode in ["pagexml", "pagexml-fast", "plaintext", "plaintext-fast"]:
+            if mode.endswith("-fast"):
+                # same again, but directly on the element tree
+                # (and with reading ahead / writing behind)
+                config.OCRD_EXISTING_OUTPUT = 'OVERWRITE'
             if mode == "plaintext":
                 input_file_grp += '-LINES'
                 # first extract line .txt files (as ocrd-segment-extract-lines would)
@@ -93,7 +124,10 @@ def test_ocrd(workspace, subtests, caplog):
                         input_file_grp=input_file_grp,
                         output_file_grp=output_file_grp,
                         parameter=dict(normalization=NRM,
-                                       allow_splits=True),
+                                       allow_splits=True,
+                                       fast_xml=mode.endswith("-fast"),
+                                       prefetch=2 if mode.endswith("-fast") else 0,
+                                       stats_file=output_file_grp + '.json'),
                         workspace=ws,
                         page_id=page_id,
                     )
@@ -108,6 +142,8 @@ def test_ocrd(workspace, subtests, caplog):
                         continue
                     if "skipping empty line" in logrec.message:
                         continue
+                    if "writing alignment statistics" in logrec.message:
+                        continue
                     if "unmatched line" in logrec.message:
                         line_id, page = logrec.message.split()[2::3]
                         assert (line_id, page) in rlines_short
@@ -125,6 +161,24 @@ def test_ocrd(workspace, subtests, caplog):
                                       key=page_order))
                 assert len(results), "found no output PAGE files"
                 assert len(results) == len(pages)
+                mode_results[mode] = [textequivs(result) for result in results]
+                if mode.endswith("-fast"):
+                    # same results as with the PAGE object model
+                    fast_results = [textequiv for page in mode_results[mode] for textequiv in page]
+                    model_results = [textequiv for page in mode_results[mode[:-5]] for textequiv in page]
+                    assert [textequiv[:-1] for textequiv in fast_results] == \
+                        [textequiv[:-1] for textequiv in model_results]
+                    # (region confidences may differ in the last digits)
+                    assert [textequiv[-1] for textequiv in fast_results] == \
+                        pytest.approx([textequiv[-1] for textequiv in model_results])
+                stats_files = list(ws.find_files(file_grp=output_file_grp, mimetype='application/json'))
+                assert len(stats_files) == 1
+                assert not stats_files[0].pageId
+                with open(os.path.join(ws.directory, stats_files[0].local_filename)) as stats_file:
+                    stats = json.load(stats_file)
+                assert stats['total']['pages'] == len(pages)
+                assert set(stats['pages']) == set(pages)
+                assert sum(stats['total']['histogram']) == stats['total']['matched']
                 result1 = results[0]
                 assert os.path.exists(result1.local_filename), "result for first page not found in filesystem"
                 otexts = [[textequiv
@@ -155,5 +209,531 @@ def test_ocrd(workspace, subtests, caplog):
                 line1_text = line1.xpath("page:TextEquiv[1]/page:Unicode/text()", namespaces=NS)[0]
                 words = line1.xpath(".//page:Word", namespaces=NS)
                 assert len(words) == 0
-    
+
+def test_ocrd_rerun(workspace, caplog):
+    ws, page_id = workspace
+    grps = [grp for grp in ws.mets.file_groups
+            if 'OCR-D-OCR-' in grp]
+    kwargs = dict(input_file_grp='OCR-D-GT-PAGE,' + grps[0],
+                  output_file_grp='OCR-D-RERUN',
+                  parameter=dict(normalization=NRM,
+                                 stats_file='OCR-D-RERUN.json'),
+                  workspace=ws,
+                  page_id=page_id)
+    def stats_files():
+        ws.save_mets()
+        return list(ws.find_files(file_grp='OCR-D-RERUN', mimetype='application/json'))
+    run_processor(NMAlignMerge, **kwargs)
+    assert len(stats_files()) == 1
+    # replaced along with the PAGE output
+    config.OCRD_EXISTING_OUTPUT = 'OVERWRITE'
+    os.remove(os.path.join(ws.directory, 'OCR-D-RERUN.json'))
+    run_processor(NMAlignMerge, **kwargs)
+    assert len(stats_files()) == 1
+    assert os.path.exists(os.path.join(ws.directory, 'OCR-D-RERUN.json'))
+    # kept along with the PAGE output
+    config.OCRD_EXISTING_OUTPUT = 'SKIP'
+    caplog.clear()
+    run_processor(NMAlignMerge, **kwargs)
+    assert len(stats_files()) == 1
+    assert any("not overwriting existing alignment statistics" in logrec.message
+               for logrec in caplog.records)
+
+def test_update_textequiv_levels():
+    pcgts = make_page(40, lines_per_region=5, regions_per_parent=4)
+    page = pcgts.get_Page()
+    tree = ET.fromstring(to_xml(pcgts).encode('utf-8')).find('page:Page', NS)
+    page_update_higher_textequiv_levels('line', pcgts)
+    xml_update_region_textequivs(tree)
+    # every odd line is joined to its predecessor
+    paragraph = page.get_TextRegion()[0].get_TextRegion()[0]
+    lines = [line.get_TextEquiv()[0].Unicode for line in paragraph.get_TextLine()]
+    assert paragraph.get_TextEquiv()[0].Unicode == '\n'.join(
+        [lines[0] + lines[1], lines[2] + lines[3], lines[4]])
+    # regions are updated bottom-up, concatenating subregions in reading order
+    order = {ref.regionRef: ref.index for ref in
+             page.get_ReadingOrder().get_OrderedGroup().get_RegionRefIndexed()}
+    for region in page.get_TextRegion():
+        paragraphs = sorted(region.get_TextRegion(), key=lambda paragraph: order[paragraph.id])
+        assert region.get_TextEquiv()[0].Unicode == '\n'.join(
+            paragraph.get_TextEquiv()[0].Unicode for paragraph in paragraphs)
+        assert region.get_TextEquiv()[0].conf == pytest.approx(
+            np.mean([paragraph.get_TextEquiv()[0].conf for paragraph in paragraphs]))
+    # same result on the element tree
+    for region in page.get_AllRegions(classes=['Text']):
+        textequiv = tree.xpath('.//page:TextRegion[@id="%s"]/page:TextEquiv' % region.id,
+                               namespaces=NS)
+        assert len(textequiv) == 1
+        assert textequiv[0].findtext('page:Unicode', namespaces=NS) == region.get_TextEquiv()[0].Unicode
+        assert float(textequiv[0].get('conf')) == pytest.approx(region.get_TextEquiv()[0].conf)
+    # from the word level
+    page_update_higher_textequiv_levels('word', pcgts)
+    for line in page.get_AllTextLines():
+        assert line.get_TextEquiv()[0].Unicode == ' '.join(
+            word.get_TextEquiv()[0].Unicode for word in line.get_Word())
+    # other schema versions are refused on the element tree
+    xml = to_xml(pcgts).encode('utf-8')
+    assert xml_get_page(ET.ElementTree(ET.fromstring(xml))) is not None
+    xml = xml.replace(NS['page'].encode('utf-8'), b'http://schema.primaresearch.org/PAGE/gts/pagecontent/2013-07-15')
+    with pytest.raises(ValueError):
+        xml_get_page(ET.ElementTree(ET.fromstring(xml)))
+
+def test_normalizer():
+    normalize = align.get_normalizer(NRM)
+    assert normalize is align.get_normalizer(dict(NRM))
+    assert normalize("Auſ- \nﬁnden") == "Aus- finden"
+    # rules are applied in order, feeding into each other
+    normalize = align.get_normalizer({"a": "b", "b": "c", "x": "yy", "y": "z"})
+    assert normalize("abxy") == "cczzz"
+
+def test_similarity_cache(tmp_path):
+    l1 = ["the quick brown fox", "jumps over", "the lazy dog"]
+    l2 = ["jumps ovr", "the quick brwn fox", "a lazy dog"]
+    res, dst = align.match(l1, l2, cutoff=0.5)
+    for cutoff in [None, 0.5, 0.5]:
+        res1, dst1 = align.match(l1, l2, cutoff=cutoff, cache_dir=str(tmp_path))
+    assert list(res1) == list(res)
+    assert np.array_equal(dst1, dst)
+    # shared across cutoffs, but not across sparse modes
+    assert len(list(tmp_path.glob('*.npy'))) == 1
+    results = align.match_cutoffs(l1, l2, [0.5], cache_dir=str(tmp_path))
+    assert list(results[0][0]) == list(res)
+    assert len(list(tmp_path.glob('*.npy'))) == 1
+    align.match(l1, l2, topk=1, cache_dir=str(tmp_path))
+    assert len(list(tmp_path.glob('*.npz'))) == 1
+    cache = align.SimilarityCache(str(tmp_path), max_size=0)
+    cache.evict()
+    assert not list(tmp_path.iterdir())
+
+def test_similarity_matrix():
+    l1 = ["the quick brown fox", "jumps over", "the lazy dog"]
+    l2 = ["jumps ovr", "the quick brwn fox", "a lazy dog"]
+    dist = align.similarity_matrix(l1, l2)
+    # edit, insert, delete and move lines
+    l1new = ["the quick brown fox", "jumped over", "the lazy dog", "!"]
+    l2new = ["the quick brwn fox", "a lazy dog", "jumps ovr"]
+    dist_incr = align.similarity_matrix(l1new, l2new, previous=(l1, l2, dist))
+    assert np.array_equal(dist_incr, align.similarity_matrix(l1new, l2new))
+    res, dst = align.match(l1new, l2new, cutoff=0.5)
+    res1, dst1 = align.match(l1new, l2new, cutoff=0.5, dist=dist_incr)
+    assert list(res1) == list(res)
+    assert np.array_equal(dst1, dst)
+
+def test_match_cutoffs():
+    l1 = ["the quick brown fox", "jumps over", "the lazy dog", "xyz"]
+    l2 = ["jumps ovr", "the quick brwn fox", "a lazy dog"]
+    cutoffs = [0.0, 0.5, 0.85, 0.95]
+    results = align.match_cutoffs(l1, l2, cutoffs)
+    assert len(results) == len(cutoffs)
+    for cutoff, (res, dst) in zip(cutoffs, results):
+        res1, dst1 = align.match(l1, l2, cutoff=cutoff)
+        assert list(res) == list(res1)
+        assert np.array_equal(dst, dst1)
+    assert list(results[-1][0]) == [-1, -1, -1, -1]
+    # sparse matrices depend on cutoff
+    with pytest.raises(ValueError):
+        align.match_cutoffs(l1, l2, cutoffs, topk=2)
+
+def test_match_optimal():
+    l1 = ["the quick brown fox jumps", "over the lazy dog", "lorem ipsum dolor sit amet", "lorem ipsum"]
+    l2 = ["lorem ipsum dolor sit amet", "lorem ipsum", "the quick brwn fox jumps over the lazy dog"]
+    res, dst = align.match(l1, l2, method='optimal')
+    assert list(res) == [2, -1, 0, 1]
+    res, _ = align.match(l1, l2, method='optimal', topk=2)
+    assert list(res) == [2, -1, 0, 1]
+    res, dst = align.match(l1, l2, method='optimal', cutoff=0.6)
+    assert list(res) == [-1, -1, 0, 1]
+    (res, beg, end), dst = align.match(l1, l2, method='optimal', try_subseg=True)
+    assert list(res) == [2, 2, 0, 1]
+    assert list(beg[:2]) == [0, 25]
+    assert list(end[:2]) == [24, 42]
+    # ties between repeated strings get resolved monotonically
+    l1 = ["header", "first line", "header", "second line", "header"]
+    res, _ = align.match(l1, list(l1), method='optimal')
+    assert list(res) == [0, 1, 2, 3, 4]
+    with pytest.raises(ValueError):
+        align.match(l1, l1, method='optimal', interactive=True)
+    # nothing to assign in sparse mode
+    res, dst = align.match(["lorem ipsum"], ["quick brown fox"], method='optimal',
+                           topk=1, cutoff=0.5)
+    assert list(res) == [-1]
+    assert list(dst) == [0]
+
+def test_match_monotone():
+    l1 = ["the quick brown fox jumps", "over the lazy dog", "lorem ipsum dolor sit amet", "lorem ipsum"]
+    l2 = ["the quick brwn fox jumps over the lazy dog", "lorem ipsum dolor sit amet", "lorem ipsum"]
+    for kwargs in [{}, dict(topk=2), dict(band=1)]:
+        res, dst = align.match(l1, l2, method='monotone', **kwargs)
+        assert list(res) == [0, -1, 1, 2]
+        (res, beg, end), dst = align.match(l1, l2, method='monotone', try_subseg=True, **kwargs)
+        assert list(res) == [0, 0, 1, 2]
+        assert list(beg[:2]) == [0, 25]
+        assert list(end[:2]) == [24, 42]
+    # out of order pairs are lost
+    res, dst = align.match(l1, l2[::-1], method='monotone', cutoff=0.5)
+    assert list(res) == [-1, -1, 1, -1]
+
+def test_assign_monotone():
+    dist = np.array([[0.9, 0.0, 0.5],
+                     [0.0, 0.0, 0.8],
+                     [0.0, 0.7, 0.0]])
+    length = np.array([10, 10, 10])
+    # 0-0 and 1-2 beat 0-0 and 2-1 (or 0-2 alone)
+    assert align.assign_monotone(dist, length) == [(0, 1, 0), (1, 2, 2)]
+    assert align.assign_monotone(csr_matrix(dist), length) == [(0, 1, 0), (1, 2, 2)]
+    # pair of rows 1-2 with column 1 (gaining 0.9) beats 1-2
+    splits = [np.array([[0.0, 0.0, 0.0],
+                        [0.0, 0.9, 0.0]])]
+    assert align.assign_monotone(dist, length, splits) == [(0, 1, 0), (1, 3, 1)]
+
+def test_split_positions():
+    assert align.split_positions(["hello wrld", "foo"], "hello world fooo") == [(0, 11), (12, 16)]
+
+def test_match_blocks():
+    l1 = ["the quick brown fox", "jumps over", "the lazy dog",
+          "lorem ipsum dolor", "sit amet", "the lazy dog"]
+    blocks1 = ["r1", "r1", "r1", "r2", "r2", "r2"]
+    l2 = ["lorem ipsum dolr", "sit amet", "the lazy dog",
+          "the quick brwn fox", "jumps ovr", "the lazy dog"]
+    blocks2 = [0, 0, 0, 1, 1, 1]
+    res, dst = align.match_blocks(l1, l2, blocks1, blocks2, cutoff=0.5)
+    # repeated lines stay within their block
+    assert list(res) == [3, 4, 5, 0, 1, 2]
+    res1, dst1 = align.match(l1, l2, cutoff=0.5)
+    assert np.allclose(dst, dst1)
+    # leftover lines get aligned globally
+    res, dst = align.match_blocks(l1, l2[:4] + l2[5:] + ["jumps over"], blocks1, [0, 0, 0, 1, 1, 2], cutoff=0.5)
+    assert list(res) == [3, 5, 4, 0, 1, 2]
+    (res, beg, end), dst = align.match_blocks(l1, l2, blocks1, blocks2, cutoff=0.5, try_subseg=True)
+    assert list(res) == [3, 4, 5, 0, 1, 2]
+
+def test_anchor_pairs():
+    l1 = ["a long unique line", "duplicate line", "duplicate line", "another unique line", "short"]
+    l2 = ["some other line", "A long unique line", "duplicate line", "another  unique line", "short"]
+    assert align.anchor_pairs(l1, l2) == [(0, 1), (3, 3)]
+    # crossing pairs cannot both be anchors
+    assert len(align.anchor_pairs(l1, l2[:1] + l2[3:4] + l2[1:3])) == 1
+
+def test_find_window():
+    rnd = np.random.default_rng(0)
+    book = ["".join(rnd.choice(list("abcdefghijklmnopqrstuvwxyz   "), 30)) for _ in range(100)]
+    # page has lines 40-59 (with some noise, reordered locally, and two extra lines)
+    page = [line.replace("o", "0") for line in book[40:60]]
+    page[3], page[4] = page[4], page[3]
+    page = ["page header"] + page + [book[5]]
+    assert align.find_window(page, book) == (40 - 1 - align.WINDOW_MARGIN,
+                                             60 + 1 + align.WINDOW_MARGIN)
+    assert align.find_window(page, book, 30, 70) == align.find_window(page, book)
+    assert align.find_window(page, book, 60, 100) is None
+    assert align.find_window(["something else"], book) is None
+
+def test_book_text(tmp_path):
+    path = tmp_path / "book.txt"
+    path.write_bytes("first line\r\n\nthird – line\nlast line".encode("utf-8"))
+    book = BookText(str(path))
+    assert len(book) == 4
+    assert book[0] == "first line"
+    assert book[1:] == ["", "third – line", "last line"]
+    path.write_bytes(b"single line\n")
+    assert BookText(str(path))[:] == ["single line"]
+    path.write_bytes(b"")
+    assert len(BookText(str(path))) == 0
+
+def test_find_book_window(tmp_path, caplog):
+    # each page continues exactly where the previous one ended
+    rnd = np.random.default_rng(5)
+    pages = [["".join(rnd.choice(list("abcdefghijklmnopqrstuvwxyz   "), 30)) for _ in range(20)]
+             for _ in range(10)]
+    path = tmp_path / "book.txt"
+    path.write_text("\n".join(line for page in pages for line in page), encoding="utf-8")
+    ws = Resolver().workspace_from_nothing(str(tmp_path))
+    for rank in range(len(pages)):
+        ws.add_file('OCR', file_id='OCR_%04d' % rank, page_id='PHYS_%04d' % rank,
+                    mimetype=MIMETYPE_PAGE, local_filename='OCR/OCR_%04d.xml' % rank, content='')
+    ws.add_file('BOOK', file_id='BOOK', page_id=None,
+                mimetype='text/plain', local_filename=str(path))
+    proc = NMAlignMerge(None, parameter={'book_text': True})
+    proc.workspace = ws
+    proc.input_file_grp = 'OCR,BOOK'
+    def process(selected):
+        proc.page_id = ','.join('PHYS_%04d' % rank for rank in selected)
+        assert len(proc.zip_input_files()) == len(selected)
+        caplog.clear()
+        for rank in selected:
+            page_id, page = 'PHYS_%04d' % rank, pages[rank]
+            start = sum(map(len, pages[:rank]))
+            # OCR with garbled first line
+            texts = ["#" * 10] + [line.replace("o", "0") for line in page[1:]]
+            begin, window = proc.find_book_window(page_id, str(path), texts)
+            res, _ = align.match(texts, window)
+            assert [begin + ind for ind in res[1:]] == list(range(start + 1, start + len(page))), page_id
+            matched = [begin + ind for ind in res if ind >= 0]
+            if not rank or rank - 1 in selected:
+                # never reaching back into the previous page
+                assert begin >= start, page_id
+                assert min(matched) >= start, page_id
+            proc.book_ends[page_id] = max(matched) + 1
+        # found near the estimated position without searching the whole text
+        assert not any("searching whole text" in logrec.message
+                       for logrec in caplog.records)
+    process(range(len(pages)))
+    # selection starting in the middle of the document
+    process(range(6, len(pages)))
+    # selection with gaps (previous physical page not processed)
+    process([0, 2, 3, 7])
+
+def test_match_anchored():
+    l1 = ["the quick brown fox", "jumps over", "the lazy dog", "lorem ipsum dolor sit amet",
+          "the quick brown fox", "jumps over", "the lazy dog"]
+    l2 = ["the quick brwn fox", "jumps ovr", "a lazy dog", "Lorem ipsum dolor sit amet",
+          "jumps over", "a lazy dog"]
+    res, dst = align.match_anchored(l1, l2, cutoff=0.5)
+    assert list(res) == [0, 1, 2, 3, -1, 4, 5]
+    assert dst[3] > 0.95
+    res, dst = align.match_anchored(l1, l2, cutoff=0.5, workers=2, method='monotone')
+    assert list(res) == [0, 1, 2, 3, -1, 4, 5]
+    (res, beg, end), dst = align.match_anchored(l1, l2, cutoff=0.5, try_subseg=True)
+    assert list(res) == [0, 1, 2, 3, -1, 4, 5]
+
+def test_monotonicity_index():
+    # compare with explicit block-triangular matrix
+    def monotonicity_matrix(dim1, dim2, pairs):
+        matrix = np.zeros((dim1, dim2), dtype=bool)
+        prev_ind1, prev_ind2 = 0, 0
+        for ind1, ind2 in sorted(pairs) + [(dim1, dim2)]:
+            if ind2 >= prev_ind2:
+                matrix[prev_ind1:ind1, prev_ind2:ind2] = True
+            else:
+                matrix[:, ind2:prev_ind2] = False
+            prev_ind1, prev_ind2 = ind1, ind2
+        return matrix
+    rng = np.random.default_rng(7)
+    for _ in range(100):
+        dim1, dim2 = rng.integers(1, 20, size=2)
+        mono = align.MonotonicityIndex(dim1, dim2)
+        pairs = []
+        for ind1 in rng.permutation(dim1)[:rng.integers(dim1)]:
+            ind2 = rng.integers(dim2)
+            mono.add(ind1, ind2)
+            pairs.append((ind1, ind2))
+            assert np.array_equal(mono.mask(np.arange(dim1), np.arange(dim2)),
+                                  monotonicity_matrix(dim1, dim2, pairs)), pairs
+
+def test_lazy_greedy():
+    # compare with explicit argmax over all remaining pairs
+    rng = np.random.default_rng(8)
+    for _ in range(50):
+        dim1, dim2 = rng.integers(1, 30, size=2)
+        # coarse values to provoke ties
+        dist = rng.integers(0, 5, size=(dim1, dim2)).astype(np.float32) / 4
+        length = rng.integers(0, 4, size=dim2)
+        keep1 = np.ones(dim1, dtype=bool)
+        keep2 = np.ones(dim2, dtype=bool)
+        mono = align.MonotonicityIndex(dim1, dim2)
+        greedy = align.LazyGreedy(dist, length, mono, keep1, keep2)
+        for step in range(min(dim1, dim2)):
+            coverage = 0.5 * step / dim1
+            priority = (dist + coverage * mono.mask(np.arange(dim1), np.arange(dim2))) * length
+            priority[~keep1] = -np.inf
+            priority[:, ~keep2] = -np.inf
+            ind1, ind2 = np.unravel_index(np.argmax(priority), priority.shape)
+            assert greedy.select(coverage)[:2] == (ind1, ind2)
+            keep1[ind1] = False
+            keep2[ind2] = False
+            for beg1, end1 in mono.add(ind1, ind2):
+                greedy.touch(beg1, end1)
+
+def test_match_lowmem():
+    # single precision row scoring on preallocated buffers gives the same result
+    rng = np.random.default_rng(3)
+    words = ["lorem", "ipsum", "dolor", "sit", "amet", "consetetur", "sadipscing", "elitr"]
+    l1 = [" ".join(rng.choice(words, size=rng.integers(2, 8))) for _ in range(60)]
+    l2 = [line.replace("o", "0").replace("m", "rn") for line in l1]
+    order = rng.permutation(len(l2))
+    l2 = [l2[i] for i in order[5:]] + ["dolor sit", "amet"]
+    for cutoff in [None, 0.6]:
+        res, dst = align.match(l1, l2, cutoff=cutoff)
+        res32, dst32 = align.match(l1, l2, cutoff=cutoff, lowmem=True, max_memory=1000)
+        assert np.array_equal(res32, res)
+        assert np.allclose(dst32, dst, atol=1e-6)
+        assert dst32.dtype == np.float32
+
+def test_cdist_topk():
+    l1 = ["foo bar", "baz", "bar foo", "qux quux", "foo"]
+    l2 = ["bar", "foo bar", "quux", "baz qux", "fo"]
+    dense = cdist(l1, l2, scorer=normalized_similarity)
+    # chunked, but complete
+    sparse = align.cdist_topk(l1, l2, len(l2), max_memory=1, scorer=normalized_similarity)
+    assert np.array_equal(sparse.toarray(), dense)
+    # incomplete
+    dense = cdist(l1, l2, scorer=normalized_similarity, score_cutoff=0.5)
+    sparse = align.cdist_topk(l1, l2, 2, score_cutoff=0.5, max_memory=1, scorer=normalized_similarity)
+    assert np.all(sparse.getnnz(axis=1) >= 2)
+    assert np.all(sparse.max(axis=1).toarray()[:, 0] == dense.max(axis=1))
+    assert np.all(sparse.toarray()[dense >= 0.5] >= 0.5)
+    res, _ = align.match(l1, l2, topk=len(l2))
+    assert np.array_equal(res, align.match(l1, l2)[0])
+
+def test_ngram_candidates():
+    l1 = ["the quick brown fox", "jumps over", "the lazy dog", "!"]
+    l2 = ["jumps ovr", "the quick brwn fox", "a lazy dog", "the end"]
+    candidates = align.ngram_candidates(l1, l2, 0.2).toarray()
+    assert candidates[0, 1] and candidates[1, 0] and candidates[2, 2]
+    assert not candidates[0, 0] and not candidates[1, 2]
+    # no informative n-grams at all
+    assert candidates[3].all()
+    sparse = align.cdist_pairs(l1, l2, candidates, scorer=normalized_similarity)
+    assert sparse.nnz == np.count_nonzero(candidates)
+    assert sparse[1, 0] == normalized_similarity(l1[1], l2[0])
+    res, _ = align.match(l1, l2, blocking=0.2)
+    assert list(res[:3]) == [1, 0, 2]
+    # pairs not scored count as 0, so lines without candidates are still assigned like without blocking
+    l1 = ["the quick brown fox", "jumps over", "xyzzy qwv", "the lazy dog"]
+    l2 = ["the quick brwn fox", "jumps ovr", "completely different", "a lazy dog"]
+    assert not align.ngram_candidates(l1, l2, 0.2)[2, 2]
+    for cutoff in [None, 0.5]:
+        res, dst = align.match(l1, l2, blocking=0.2, cutoff=cutoff)
+        assert np.array_equal(res, align.match(l1, l2, cutoff=cutoff)[0])
+    assert res[2] == -1
+    res, dst = align.match(l1, l2, blocking=0.2)
+    assert res[2] == 2 and dst[2] == 0
+    # combined with topk: only the best of the pairs scored
+    res, dst = align.match(l1, l2, blocking=0.2, topk=1)
+    assert list(res) == [0, 1, -1, 3]
+
+def test_charbag_candidates():
+    l1 = ["the quick brown fox", "jumps over", "the lazy dog", ""]
+    l2 = ["jumps ovr", "the quick brwn fox", "a lazy dog", "", "the lazy fox"]
+    dist = cdist(l1, l2, scorer=normalized_similarity)
+    for cutoff in [0.3, 0.5, 0.8]:
+        candidates = align.charbag_candidates(l1, l2, score_cutoff=cutoff, max_memory=100)
+        # upper bound: no pair above cutoff gets lost
+        assert not np.any((dist >= cutoff) & ~candidates.toarray())
+    assert align.charbag_candidates(l1, l2, score_cutoff=0.8).nnz < dist.size
+    candidates = align.charbag_candidates(l1, l2, topk=1)
+    assert candidates.nnz == len(l1) * align.PREFILTER_TOPK_FACTOR
+    res, dst = align.match(l1[:3], l2, cutoff=0.5, prefilter=True)
+    assert list(res) == [1, 0, 4]
+    # combined with topk
+    res, dst = align.match(l1[:3], l2, cutoff=0.5, prefilter=True, topk=1)
+    assert list(res) == [1, 0, 4]
+    with pytest.raises(ValueError):
+        align.match(l1, l2, blocking=0.2, prefilter=True)
+
+def test_cdist_band():
+    l1 = ["line %d of some text" % i for i in range(19)] + ["the end"]
+    l2 = l1[:10] + ["another line"] + l1[10:19] + ["ZZZ"]
+    dense = cdist(l1, l2, scorer=normalized_similarity)
+    sparse = align.cdist_band(l1, l2, 1, scorer=normalized_similarity)
+    # within the band
+    assert sparse[5].nnz == 3
+    assert np.allclose(sparse[5, 4:7].toarray(), dense[5, 4:7])
+    # widened for rows without good match
+    assert sparse[19].nnz == len(l2)
+    res, _ = align.match(l1, l2, band=1)
+    assert list(res[:19]) == list(range(10)) + list(range(11, 20))
+    # not combined with other sparse modes
+    for kwargs in [dict(topk=1), dict(blocking=0.2), dict(prefilter=True, cutoff=0.5)]:
+        with pytest.raises(ValueError):
+            align.match(l1, l2, band=1, **kwargs)
+
+def test_match_subseg():
+    l1 = ["hello wrld", "foo bar baz", "something else"]
+    seg2 = "hello world foo bar baz"
+    res = align.match_subseg(l1, seg2, np.array([0.6, 0.6, 0.1]), np.arange(3))
+    assert [(ind1, beg2, end2) for ind1, beg2, end2, _ in res] == [(0, 0, 10), (1, 12, 23)]
+    # exact local alignments
+    assert res[1][3] == 1.0
+    assert align.match_subseg(l1, seg2, np.array([0.6, 0.6, 0.1]), np.arange(3), min_score=0.99) == []
+    res = align.match_subseg(l1, seg2, np.array([0.6, 0.6, 0.1]), np.arange(3), exact=True)
+    assert [(ind1, beg2, end2) for ind1, beg2, end2, _ in res] == [(0, 0, 11), (1, 12, 23)]
+    # reusing workers across calls
+    with joblib.Parallel(n_jobs=2) as parallel:
+        for _ in range(2):
+            res = align.match_subseg(l1, seg2, np.array([0.6, 0.6, 0.1]), np.arange(3),
+                                     workers=2, parallel=parallel)
+            assert [(ind1, beg2, end2) for ind1, beg2, end2, _ in res] == [(0, 0, 10), (1, 12, 23)]
+    # reusing local alignments across calls
+    memo = dict()
+    for _ in range(2):
+        res = align.match_subseg(l1, seg2, np.array([0.6, 0.6, 0.1]), np.arange(3), memo=memo)
+        assert [(ind1, beg2, end2) for ind1, beg2, end2, _ in res] == [(0, 0, 10), (1, 12, 23)]
+    assert ("foo bar baz", seg2) in memo['partial_ratio_alignment']
+
+def test_subseg_path():
+    # compare with shortest path through dense matrix of spans and gaps (as before)
+    def shortest_path_dense(spans, len2):
+        len2 = len2 + 1
+        subscoresfor2 = np.inf * np.ones((len2, len2))
+        subindxesfor2 = -1 * np.ones((len2, len2), dtype=int)
+        for i in range(len2):
+            for j in range(i + 1, len2):
+                subscoresfor2[i, j] = j - i # forward gap
+                subscoresfor2[j, i] = j - i # backward gap
+        for (start, end), (subdst1, subind1) in spans.items():
+            subscoresfor2[start, end] = subdst1
+            subindxesfor2[start, end] = subind1
+        subdist, subpath = shortest_path(csgraph=csr_matrix(subscoresfor2),
+                                         indices=0, return_predecessors=True)
+        path = []
+        subpos = len2 - 1
+        while subpos > 0:
+            prepos = max(0, subpath[subpos])
+            if subindxesfor2[prepos, subpos] >= 0:
+                path.append((subindxesfor2[prepos, subpos], prepos, subpos))
+            subpos = prepos
+        return subdist[-1], list(reversed(path))
+    rng = np.random.default_rng(7)
+    for ties in [False, True]:
+        for _ in range(200):
+            len2 = int(rng.integers(5, 40))
+            spans = dict()
+            for subind1 in range(rng.integers(0, 6)):
+                start = int(rng.integers(0, len2))
+                end = int(rng.integers(start + 1, len2 + 1))
+                if ties:
+                    subdst1 = float(rng.integers(1, end - start + 1))
+                else:
+                    subdst1 = rng.uniform(0.01, 0.5) * (end - start)
+                spans[start, end] = subdst1, subind1
+            total, path = align.subseg_path(spans, len2)
+            total0, path0 = shortest_path_dense(spans, len2)
+            assert total == pytest.approx(total0)
+            if not ties:
+                assert [subind1 for subind1, _, _, _ in path] == [subind1 for subind1, _, _ in path0]
+            # (otherwise, another path with the same total may be chosen)
+            assert total == pytest.approx(sum(start for _, start, _, _ in path[:1]) +
+                                          sum((1 - subscore) * (end - start) for _, start, end, subscore in path) +
+                                          sum(abs(start - end) for (_, _, end, _), (_, start, _, _)
+                                              in zip(path, path[1:])) +
+                                          len2 - (path[-1][2] if path else 0))
+    # exact alignments (zero distance) are kept (but were lost in the sparse matrix)
+    spans = {(0, 5): (0.0, 0), (6, 10): (0.0, 1)}
+    assert align.subseg_path(spans, 10) == (1.0, [(0, 0, 5, 1.0), (1, 6, 10, 1.0)])
+    assert shortest_path_dense(spans, 10)[0] > 1.0
+    # for duplicate spans, the best alignment is kept (not the last one written)
+    l1 = ["first candidate", "second candidate", "third one"]
+    seg2 = "the first candidate, third one"
+    def subseg(score1, score2):
+        memo = dict(partial_ratio={(seg1, seg2): 90 for seg1 in l1},
+                    partial_ratio_alignment={(l1[0], seg2): (score1, 4, 19),
+                                             (l1[1], seg2): (score2, 4, 19),
+                                             (l1[2], seg2): (0.9, 21, 30)})
+        res = align.match_subseg(l1, seg2, np.array([0.5, 0.5, 0.5]), np.arange(3), memo=memo)
+        return [subind1 for subind1, _, _, _ in res]
+    assert subseg(0.9, 0.6) == [0, 2]
+    # (but among equally good ones, still the last one)
+    assert subseg(0.9, 0.9) == [1, 2]
+
+def test_smith_waterman():
+    scores, starts, ends = align.smith_waterman(["quick brwn", "lazy", "QQ", ""],
+                                                "the quick brown fox jumps over the lazy dog")
+    assert list(starts[:2]) == [4, 35]
+    assert list(ends[:2]) == [15, 39]
+    # 10 matches minus 1 gap
+    assert scores[0] == 0.9
+    assert scores[1] == 1.0
+    assert scores[2] == 0.0
+    assert scores[3] == 0.0
+
 # fixme: test script, test API directly